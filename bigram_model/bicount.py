@@ -20,13 +20,18 @@
 
 import marshal
 import logging
+import os
 import sys
 from collections import Counter
 from math import log
 from string import ascii_lowercase
 from itertools import product
 
-from bisort import normalize
+# textnorm lives in ../character_ngram:
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "character_ngram"
+))
+import textnorm
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
 logger = logging.getLogger(__name__)
@@ -39,8 +44,7 @@ total = 0
 counts = Counter()
 
 logger.info("Loading data, will report every %d lines", LOG_EVERY)
-for i, line in enumerate(sys.stdin):
-    text = normalize(line)
+for i, text in enumerate(textnorm.LATIN.lines(sys.stdin)):
     if text:
         total += len(text) - 1
         counts += Counter("".join(bigram) for bigram in zip(text, text[1:]))
@@ -19,11 +19,15 @@
 ##
 
 from sys import stdin, argv, exit
-import unicodedata
-import re
 import marshal
+import os
+import sys
 
-nonalpha = re.compile("[^a-zA-Z]")
+# textnorm lives in ../character_ngram:
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "character_ngram"
+))
+import textnorm
 
 def bigram_loss(bigram):
     return bigram_statistics[bigram]
@@ -35,12 +39,12 @@ def sort_texts(texts):
     return sorted(texts, key=text_loss)
 
 def normalize(text):
-    return nonalpha.sub("", unicodedata.normalize("NFKD", text).lower())
+    return textnorm.LATIN(text)
 
 if __name__ == "__main__":
     if len(argv) != 2:
         exit("Usage: {} model.bin < input.txt".format(argv[0]))
     with open(argv[1], "rb") as f:
         bigram_statistics = marshal.load(f)
-    for text in sort_texts(normalize(text) for text in stdin.readlines()):
+    for text in sort_texts(textnorm.LATIN.lines(stdin)):
         print(text)
@@ -18,13 +18,21 @@
 
 __all__ = ["esorted"]
 
+import bz2
+import collections
 import functools
-import gzip
 import heapq
 import io
 import itertools
+import lzma
 import marshal
+import math
+import multiprocessing
+import operator
+import os
+import struct
 import tempfile
+import zlib
 
 import resourceman
 
@@ -121,75 +129,279 @@ class PersistentFile(io.RawIOBase):
         return file_pool
 
 
+def _identity(data, level=None):
+    return data
+
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, -1 if level is None else level)
+
+
+def _lzma_compress(data, level):
+    return lzma.compress(data, preset=level)
+
+
+def _bz2_compress(data, level):
+    return bz2.compress(data, 9 if level is None else level)
+
+
+# Codecs of frames: name -> (id in the frame header, compress, decompress)
+CODECS = {
+    "none": (0, _identity, _identity),
+    "zlib": (1, _zlib_compress, zlib.decompress),
+    "lzma": (2, _lzma_compress, lzma.decompress),
+    "bz2": (3, _bz2_compress, bz2.decompress),
+}
+DECOMPRESS = {ident: decompress for ident, _, decompress in CODECS.values()}
+
+# Frame header: codec id and length of the (compressed) frame
+FRAME_HEADER = struct.Struct("<BI")
+# Approximate size of a frame, uncompressed:
+FRAME_SIZE = 2**16
+
+
+def get_frames(items, frame_size=FRAME_SIZE):
+    """Yield marshalled lists of items, each about `frame_size` long."""
+    items = iter(items)
+    count = 256
+    while True:
+        block = list(itertools.islice(items, count))
+        if not block:
+            return
+        data = marshal.dumps(block)
+        yield data
+        count = max(1, count*frame_size//len(data))
+
+
 class Bucket(object):
-    @staticmethod
-    def _write_chunks(fp, chunks):
-        for chunk in chunks:
-            fp.write(chunk)
+    """Temporary file with sorted items.
 
-    def __init__(self, tempdir, file_pool, chunks, compresslevel):
-        self.compresslevel = compresslevel
-        self.file_pool = file_pool
-        fd, self.filename = tempfile.mkstemp(dir=tempdir)
-        with open(fd, "wb") as fp:
-            if compresslevel == 0:
-                self._write_chunks(fp, chunks)
-                return
-            with gzip.open(fp, "wb", compresslevel=compresslevel) as zipfile:
-                self._write_chunks(zipfile, chunks)
+    The items are stored in frames, each holding a marshalled list of
+    items, compressed by the codec given in the frame header.
+    """
 
     @staticmethod
-    def serialize(item):
-        return marshal.dumps(item)
+    def write(tempdir, items, compression):
+        """Write items to a new temporary file, return its name.
+
+        `compression` is a pair of a codec name and a level (or None).
+        """
+        codec, level = compression
+        ident, compress, _ = CODECS[codec]
+        fd, filename = tempfile.mkstemp(dir=tempdir)
+        with open(fd, "wb") as fp:
+            for data in get_frames(items):
+                data = compress(data, level)
+                fp.write(FRAME_HEADER.pack(ident, len(data)))
+                fp.write(data)
+        return filename
+
+    def __init__(self, filename, file_pool):
+        self.file_pool = file_pool
+        self.filename = filename
 
     @functools.cached_property
     def fp(self):
-        persistent_file = PersistentFile(self.filename, self.file_pool)
-        if self.compresslevel == 0:
-            return persistent_file
-        return gzip.open(persistent_file)
+        return PersistentFile(self.filename, self.file_pool)
+
+    def _read(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        pos = 0
+        while pos < size:
+            length = self.fp.readinto(view[pos:])
+            if not length:
+                break
+            pos += length
+        return data[:pos]
 
     def __iter__(self):
         while True:
-            try:
-                yield marshal.load(self.fp)
-            except EOFError:
+            header = self._read(FRAME_HEADER.size)
+            if not header:
                 return
+            ident, length = FRAME_HEADER.unpack(header)
+            yield from marshal.loads(DECOMPRESS[ident](self._read(length)))
 
+    def remove(self):
+        os.remove(self.filename)
 
-def dump_stack(tempdir, key, file_pool, stack, compresslevel):
-    stack.sort(key=lambda element: key(element[0]))
-    return Bucket(
-        tempdir=tempdir,
-        file_pool=file_pool,
-        chunks=(chunk for item, chunk in stack),
-        compresslevel=compresslevel,
-    )
 
+first = operator.itemgetter(0)
+second = operator.itemgetter(1)
+last = operator.itemgetter(-1)
 
-def get_buckets(items, key, filesize, tempdir, file_pool, compresslevel):
-    size = 0
-    stack = []
-    for item in items:
-        chunk = Bucket.serialize(item)
-        chunk_len = len(chunk)
-        size += chunk_len
-        if size > filesize and stack:
-            yield dump_stack(tempdir, key, file_pool, stack, compresslevel)
-            stack.clear()
-            size = chunk_len
-        stack.append((item, chunk))
 
-    if stack:
-        yield dump_stack(tempdir, key, file_pool, stack, compresslevel)
+class Records(object):
+    """Records stored in temporary files for items, and their reduction.
+
+    A record is the item itself, or a tuple of the key (if stored),
+    the item and its count (if counted). Records are passed to worker
+    processes, so `key` has to be picklable there.
+    """
+
+    def __init__(self, key, store_keys=False, unique=False, count=False,
+                 limit=None):
+        self.item_key = key
+        # Keys of unique items are needed twice, so they are stored:
+        self.store_keys = (store_keys or unique or count) and key is not None
+        self.unique = unique or count
+        self.count = count
+        self.limit = limit
+        # Key of the records:
+        self.key = first if self.store_keys or count else key
+
+    def make(self, items):
+        """Return a list of records for items."""
+        key = self.item_key
+        if self.store_keys and self.count:
+            return [(key(item), item, 1) for item in items]
+        if self.store_keys:
+            return [(key(item), item) for item in items]
+        if self.count:
+            return [(item, 1) for item in items]
+        return list(items)
+
+    @staticmethod
+    def _total(group):
+        record = next(group)
+        return record[:-1] + (record[-1] + sum(map(last, group)),)
+
+    def reduce(self, records):
+        """Reduce sorted records to the unique or counted ones, at most
+        `limit` of them."""
+        if self.unique:
+            groups = itertools.groupby(records, key=self.key)
+            if self.count:
+                records = (self._total(group) for _, group in groups)
+            else:
+                records = (next(group) for _, group in groups)
+        if self.limit is not None:
+            records = itertools.islice(records, self.limit)
+        return records
+
+    def items(self, records):
+        """Return items of records, or pairs of (item, count)."""
+        if self.count:
+            return (record[-2:] for record in records)
+        if self.store_keys:
+            return map(second, records)
+        return records
+
+
+# Items are marshalled in batches of this many items while reading, to
+# measure their size (and to pass them to workers):
+BATCH_SIZE = 256
+
+
+def get_batches(items, filesize):
+    """Yield lists of marshalled batches of items, each list about
+    `filesize` bytes long, to be sorted into one bucket."""
+    size = 0
+    batches = []
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, BATCH_SIZE))
+        if not batch:
+            break
+        chunk = marshal.dumps(batch)
+        if size + len(chunk) > filesize and batches:
+            yield batches
+            batches = []
+            size = 0
+        batches.append(chunk)
+        size += len(chunk)
+
+    if batches:
+        yield batches
+
+
+def write_batches(task):
+    """Sort the items of marshalled batches into a new temporary file,
+    return its name. Run in worker processes with more jobs."""
+    tempdir, records, batches, compression = task
+    items = records.make(
+        item for batch in batches for item in marshal.loads(batch)
+    )
+    items.sort(key=records.key)
+    return Bucket.write(tempdir, records.reduce(items), compression)
+
+
+def get_buckets(items, records, filesize, tempdir, file_pool, compression):
+    for batches in get_batches(items, filesize):
+        filename = write_batches((tempdir, records, batches, compression))
+        yield Bucket(filename, file_pool)
+
+
+def get_buckets_parallel(items, records, filesize, tempdir, file_pool,
+                         compression, jobs):
+    # Buckets are sorted and written by the pool while the items are
+    # read; at most two per process wait in the queue, to bound memory.
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for batches in get_batches(items, filesize):
+            pending.append(pool.apply_async(
+                write_batches, ((tempdir, records, batches, compression),)
+            ))
+            if len(pending) > 2*jobs:
+                yield Bucket(pending.popleft().get(), file_pool)
+        while pending:
+            yield Bucket(pending.popleft().get(), file_pool)
+
+
+def merge_passes(buckets, records, nofile, tempdir, file_pool, compression):
+    """Merge buckets into larger ones until at most `nofile` are left.
+
+    Intermediate passes merge `nofile` - 1 buckets at a time (one more
+    file is being written), the final merge all the `nofile` left. The
+    number of passes is the least that suffices for that. Each pass
+    merges only as many buckets as needed to leave few enough for the
+    remaining passes, so that less data are rewritten. A merged bucket
+    takes the place of its group, which keeps the sort stable.
+    """
+    buckets = list(buckets)
+    nofile = max(3, nofile)
+    fanin = nofile - 1
+    while len(buckets) > nofile:
+        # Buckets left after this pass, so that the remaining ones do:
+        target = nofile
+        while target*fanin < len(buckets):
+            target *= fanin
+        merged = []
+        i = 0
+        while i < len(buckets):
+            excess = len(merged) + len(buckets) - i - target
+            group = buckets[i:i + min(fanin, excess + 1)]
+            if len(group) < 2:
+                merged.extend(buckets[i:])
+                break
+            i += len(group)
+            filename = Bucket.write(
+                tempdir=tempdir,
+                items=records.reduce(
+                    heapq.merge(*group, key=records.key)
+                ),
+                compression=compression,
+            )
+            for bucket in group:
+                bucket.remove()
+            merged.append(Bucket(filename, file_pool))
+        buckets = merged
+    return buckets
 
 
 def esorted(
-        items, key=lambda x: x,
+        items, key=None,
         memsize=2**24,
         filesize=2**17,
         nofile=17,
-        compresslevel=0):
+        compresslevel=0,
+        jobs=1,
+        codec=None,
+        store_keys=False,
+        unique=False,
+        count=False,
+        limit=None):
     """Sort an iterable using controlled memory footprint.
 
     Parameters
@@ -198,6 +410,7 @@ def esorted(
         Items to be sorted.
     key : Callable[[Any], Any], optional
         Key function to be used to compare items.
+        The default, None compares the items themselves.
     memsize : int, optional
         Approximate threshold for RAM usage.
         Algorithm will use external sort if RAM usage would be greater.
@@ -207,21 +420,46 @@ def esorted(
         Maximum size of temporary files, in uncompressed form.
         The default, 128 KiB seems to go well with 1 MiB L2 cache.
     nofile : int, optional
-        Maximum number of open file descriptors.
+        Maximum number of open file descriptors. If there are more
+        temporary files, they are first merged into fewer larger ones.
         Speedup for higher values should be noticable mainly for
         real-life inputs, where data are not in truly random order.
         The dafault, 17 is quite moderate on today's systems;
         it is taken from the default for GNU sort when getrlimit
         functionality is unavailable.
     compresslevel : int, optional
-        gzip compression level
-        The default, 0 disables gzip completely.
+        Compression level of temporary files.
+        The default, 0 disables compression, unless `codec` is given.
+    jobs : int, optional
+        Number of worker processes sorting, serializing and compressing
+        temporary files while the items are read. With more than one,
+        `key` has to be picklable (e.g. not a lambda).
+        The default, 1 does all the work in the calling process.
+    codec : str, optional
+        Compression of temporary files: "none", "zlib", "lzma" or "bz2".
+        The default is "zlib" with `compresslevel`, otherwise "none".
+    store_keys : bool, optional
+        Store the key of each item next to it in temporary files, so
+        that the key is computed only once per item, rather than again
+        when merging. Keys have to be serializable by `marshal`.
+        The default, False is better for cheap keys.
+    unique : bool, optional
+        Yield only the first of items with equal keys, like `sort -u`.
+        Duplicates are dropped from temporary files as well.
+    count : bool, optional
+        Like `unique`, but yield pairs of (item, number of items with
+        its key), like `uniq -c`.
+    limit : int, optional
+        Yield at most `limit` items (or pairs). Temporary files keep
+        only as many, and the merge stops as soon as they are yielded.
+        The default, None yields all of them.
 
     Returns
     -------
     Iterable
         Items sorted.
     """
+    records = Records(key, store_keys, unique, count, limit)
     item_list = []
     item_iter = iter(items)
     size = 0
@@ -231,17 +469,42 @@ def esorted(
             break
         size += len(marshal.dumps(item))
     else:
-        item_list.sort(key=key)
-        yield from item_list
+        if not records.unique:
+            item_list.sort(key=key)
+            yield from itertools.islice(item_list, limit)
+            return
+        item_list = records.make(item_list)
+        item_list.sort(key=records.key)
+        yield from records.items(records.reduce(item_list))
         return
 
+    if codec is None:
+        codec = "zlib" if compresslevel else "none"
+    if codec not in CODECS:
+        raise ValueError("unknown codec: {!r}".format(codec))
+    compression = (codec, compresslevel or None)
+
     with tempfile.TemporaryDirectory() as tempdir:
-        buckets = get_buckets(
+        bucket_kwargs = dict(
             items=itertools.chain(item_list, item_iter),
-            key=key,
+            records=records,
             filesize=filesize,
             tempdir=tempdir,
             file_pool=PersistentFile.get_file_pool(nofile),
-            compresslevel=compresslevel,
+            compression=compression,
+        )
+        if jobs > 1:
+            buckets = get_buckets_parallel(jobs=jobs, **bucket_kwargs)
+        else:
+            buckets = get_buckets(**bucket_kwargs)
+        buckets = merge_passes(
+            buckets=buckets,
+            records=records,
+            nofile=nofile,
+            tempdir=tempdir,
+            file_pool=bucket_kwargs["file_pool"],
+            compression=compression,
+        )
+        yield from records.items(
+            records.reduce(heapq.merge(*buckets, key=records.key))
         )
-        yield from heapq.merge(*buckets, key=key)
@@ -16,34 +16,72 @@
 # THE USE OR PERFORMANCE OF THIS SOFTWARE.
 ##
 
+import functools
 import gzip
 import heapq
+import itertools
 import json
 import math
-import re
+import operator
+import os
 import sys
-import unicodedata
+
+import extsort
+import jmcfsa
+import jmcmap
+import textnorm
 
 
 class Jmc(object):
-    _nonalpha = re.compile("[^a-z]")
+    # Counter of events, set by `jmcstats.Stats.instrument`:
+    counters = None
 
-    def __init__(self, stats):
+    def __init__(self, stats, min_losses=None):
         self.order = len(stats)
         self.stats = stats
+        if min_losses is not None:
+            self.min_losses = min_losses
+
+    @functools.cached_property
+    def min_losses(self):
+        """Minimum loss in each backoff branch"""
+        return [min(branch.values(), default=math.inf) for branch in self.stats]
+
+    @functools.cached_property
+    def automaton(self):
+        """Backoff automaton scoring one character at a time"""
+        return jmcfsa.Automaton(self)
 
     def get_descriptor(self):
-        return {"stats": self.stats}
+        return {"stats": self.stats, "min_losses": self.min_losses}
 
     def dump(self, fp):
         with gzip.open(fp, "wt", encoding="ascii") as zipfile:
             json.dump(self.get_descriptor(), zipfile, indent=4, sort_keys=True)
             zipfile.write("\n")
 
+    def dump_mapped(self, fp):
+        jmcmap.dump(self.stats, fp, self.min_losses)
+
     @classmethod
     def load(cls, fp):
+        if jmcmap.is_mapped(fp):
+            return cls(**jmcmap.load_descriptor(fp))
         with gzip.open(fp, "rt", encoding="utf-8") as zipfile:
-            return cls(**json.load(zipfile))
+            descriptor = json.load(zipfile)
+        # Quantized models (see `jmccompact`) store codes of losses:
+        quantization = descriptor.pop("quantization", None)
+        if quantization is not None:
+            low, step = quantization
+            values = {}
+            descriptor["stats"] = [
+                {
+                    gram: values.setdefault(code, low + code*step)
+                    for gram, code in branch.items()
+                }
+                for branch in descriptor["stats"]
+            ]
+        return cls(**descriptor)
 
     def decorate(self, line):
         return (self.order - 1)*"\n" + line + "\n"
@@ -53,14 +91,11 @@ class Jmc(object):
 
     @staticmethod
     def latin(line):
-        return Jmc._nonalpha.sub(
-            "", unicodedata.normalize("NFKD", line).lower()
-        )
+        return textnorm.LATIN(line)
 
     @staticmethod
     def alpha(line):
-        import unidecode
-        return Jmc._nonalpha.sub("", unidecode.unidecode(line).lower())
+        return textnorm.ALPHA(line)
 
     @staticmethod
     def presort(limit, lines):
@@ -94,35 +129,138 @@ class Jmc(object):
         )
 
     def losses(self, line):
-        ngrams = (
+        state = self.automaton.state_at(line, self.order - 1)
+        for char in line[self.order - 1:]:
+            loss, state = state[char]
+            yield loss
+
+    def loss(self, line):
+        return self.partial_loss(line)[0]/(len(line) + 1 - self.order)
+
+    def ngrams(self, line):
+        """List n-grams of `line`, which is not decorated."""
+        line = self.decorate(line)
+        return [
             line[k:k + self.order]
             for k in range(len(line) - self.order + 1)
-        )
+        ]
 
+    def ngram_loss(self, ngrams):
+        """Like `loss`, but for n-grams listed by `ngrams`."""
+        result = 0
         prev_order = self.order
         for ngram in ngrams:
             loss, prev_order = self.single_loss(ngram, prev_order)
-            yield loss
+            result += loss
+        return result/len(ngrams)
 
-    def loss(self, line):
-        return sum(self.losses(line))/(len(line) + 1 - self.order)
-        # TODO: peek at next line and determine x=len(os.path.commonprefix);
-        # cache prev_order and sum of losses corresponding to numbers up to x;
-        # and use it next time to speed up calculation
+    def partial_loss(self, line, start=0, total=0, prev_order=None):
+        """Add losses of n-grams of `line` from position `start` on.
+
+        Returns the new total and backoff state, so that scoring can be
+        resumed once more characters are appended to the line.
+        """
+        end = start + self.order - 1
+        state = self.automaton.state_at(line, end, prev_order)
+        for char in line[end:]:
+            loss, state = state[char]
+            total += loss
+        return total, state.prev_order
 
-    def iloss(self, line, top):
+    def prefix_losses(self, lines):
+        """Score each line, reusing work on the prefix shared with the
+        previous line.
+
+        Partial loss sums and backoff states are cached per n-gram, so
+        lexicographically ordered input (a prefix trie walked in order,
+        like `presort` output or permutations of sorted items) has each
+        distinct context scored only once.
+        """
+        order = self.order
+        previous = ""
+        sums = [0]
+        states = [None]
+        for line in lines:
+            common = len(os.path.commonprefix((previous, line)))
+            keep = min(max(0, common - order + 1), len(sums) - 1)
+            del sums[keep + 1:]
+            del states[keep + 1:]
+            if keep == 0:
+                states[0] = self.automaton.state_at(line, order - 1)
+            result = sums[-1]
+            state = states[-1]
+            for char in line[keep + order - 1:]:
+                loss, state = state[char]
+                result += loss
+                sums.append(result)
+                states.append(state)
+            previous = line
+            yield result/(len(line) + 1 - order)
+
+    def iloss(self, line, top=math.inf):
+        """Like `loss`, but give up and return `math.inf` as soon as
+        the loss cannot get below `top`.
+
+        Every remaining n-gram is assumed to cost at least the minimum
+        of `min_losses`.
+        """
+        count = len(line) + 1 - self.order
+        min_loss = min(self.min_losses)
+        # Slightly relaxed, so that rounding never discards a line
+        # which would make it below top:
+        slack = (top - min_loss)*count*(1 + 1e-9)
+        excess = 0
         result = 0
         for loss in self.losses(line):
             result += loss
-        return result/(len(line) + 1 - self.order)
+            excess += loss - min_loss
+            if excess > slack:
+                return math.inf
+        return result/count
+
+    def scored(self, lines, shared_prefix=False):
+        """Yield pairs of (loss, line)."""
+        if shared_prefix:
+            lines, scored_lines = itertools.tee(lines)
+            return zip(self.prefix_losses(scored_lines), lines)
+        return ((self.loss(line), line) for line in lines)
 
-    def sort(self, lines):
+    def sort(self, lines, shared_prefix=False):
+        if shared_prefix:
+            lines = sorted(lines)
+            scored = sorted(
+                zip(self.prefix_losses(lines), lines),
+                key=lambda pair: pair[0],
+            )
+            return [line for loss, line in scored]
         return sorted(lines, key=lambda line: self.loss(line))
-        # TODO: implement external sort, to avoid RAM depletion
-        # TODO: before scoring, put common prefixes together and make use of it
 
     @staticmethod
-    def nlargest(n, iterable, key):
+    def esort_scored(scored, **kwargs):
+        """Sort pairs of (loss, line) by loss using `extsort.esorted`.
+
+        Losses are stored next to the lines in temporary files, so they
+        are not recomputed when merging. Keyword arguments are passed
+        to `extsort.esorted`. Yields lines.
+        """
+        for loss, line in extsort.esorted(
+                scored, key=operator.itemgetter(0), **kwargs):
+            yield line
+
+    def esort(self, lines, shared_prefix=False, **kwargs):
+        """Like `sort`, but bounded in memory; see `esort_scored`.
+
+        With `shared_prefix`, only prefixes shared by consecutive lines
+        are reused, as the input is not sorted beforehand.
+        """
+        return self.esort_scored(
+            self.scored(lines, shared_prefix), **kwargs
+        )
+
+    @staticmethod
+    def nlargest(n, iterable, key, counters=None):
+        # The first n elements must not be visited again below:
+        iterable = iter(iterable)
         result = [(key(elem), i, elem)
                   for i, elem in zip(range(0, -n, -1), iterable)]
         if not result:
@@ -137,12 +275,20 @@ class Jmc(object):
                 heapreplace(result, (k, order, elem))
                 top = result[0][0]
                 order -= 1
+        if counters is not None:
+            counters["heap_replacements"] += -n - order
         result.sort(reverse=True)
         return [elem for (k, order, elem) in result]
 
-    def best(self, limit, lines):
+    def best(self, limit, lines, shared_prefix=False):
+        if shared_prefix:
+            return [line for loss, line in self.nlargest(
+                limit, self.scored(lines, shared_prefix),
+                key=lambda pair, top=math.inf: -pair[0],
+                counters=self.counters,
+            )]
         return self.nlargest(
             limit, lines,
-            key=lambda line, top=math.inf: -self.iloss(line, top),
+            key=lambda line, top=-math.inf: -self.iloss(line, -top),
+            counters=self.counters,
         )
-        # TODO: before scoring, put common prefixes together and make use of it
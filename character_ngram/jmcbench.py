@@ -0,0 +1,162 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Benchmarks of the scoring engine.
+#
+# Each benchmark runs one command (like `loss` or `best`) on one
+# reproducible workload. It runs in a new worker process, so that the
+# model load time and the peak resident set size are its own.
+
+__all__ = ["MODEL", "WORKLOADS", "COMMANDS", "run", "benchmark"]
+
+import glob
+import itertools
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import string
+import time
+
+import jmc
+import textnorm
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+MODEL = os.path.join(DIRECTORY, "praha4.jmc")
+OSMNAMES = os.path.join(DIRECTORY, os.pardir, "data", "osmnames")
+DEFAULT_SIZE = 2**16
+DEFAULT_REPEAT = 3
+BEST_LIMIT = 10
+PRESORT_LIMIT = 2**20
+
+
+def permutations(size, seed=0):
+    """Permutations of letters, like candidates of an anagram."""
+    letters = list("vinohrady")
+    random.Random(seed).shuffle(letters)
+    return ["".join(p) for p in itertools.islice(
+        itertools.permutations(letters), size
+    )]
+
+
+def random_strings(size, seed=0):
+    """Random strings of lowercase letters, 5 to 15 characters long."""
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 15)))
+        for _ in range(size)
+    ]
+
+
+def names(size, seed=0):
+    """Street and place names of `data/osmnames`, normalized."""
+    filenames = sorted(glob.glob(os.path.join(OSMNAMES, "*.names.txt")))
+    if not filenames:
+        raise FileNotFoundError("no name lists in {}".format(OSMNAMES))
+    lines = []
+    for filename in filenames:
+        with open(filename, encoding="utf-8") as fp:
+            lines.extend(textnorm.LATIN.lines(fp))
+    rng = random.Random(seed)
+    return [rng.choice(lines) for _ in range(size)]
+
+
+WORKLOADS = {
+    "permutations": permutations,
+    "random": random_strings,
+    "names": names,
+}
+
+
+def _loss(model, lines):
+    for line in lines:
+        model.loss(line)
+
+
+def _sort(model, lines):
+    model.sort(lines)
+
+
+def _best(model, lines):
+    model.best(BEST_LIMIT, lines)
+
+
+def _presort(model, lines):
+    for line in jmc.Jmc.presort(PRESORT_LIMIT, lines):
+        pass
+
+
+COMMANDS = {
+    "loss": _loss,
+    "sort": _sort,
+    "best": _best,
+    "presort": _presort,
+}
+
+
+def run(model_filename, workload, command, size, repeat):
+    """Run a single benchmark in this process, return its results.
+
+    The workload is generated and decorated before the timing starts.
+    The time of the command is the best of `repeat` runs.
+    """
+    start = time.perf_counter()
+    model = jmc.Jmc.load(model_filename)
+    load_seconds = time.perf_counter() - start
+
+    lines = [model.decorate(line) for line in WORKLOADS[workload](size)]
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        COMMANDS[command](model, lines)
+        seconds.append(time.perf_counter() - start)
+    best = min(seconds)
+    return {
+        "workload": workload,
+        "command": command,
+        "lines": len(lines),
+        "seconds": best,
+        "lines_per_second": len(lines)/best if best else None,
+        "load_seconds": load_seconds,
+        # Kilobytes on Linux:
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def benchmark(model_filename=MODEL, workloads=WORKLOADS, commands=COMMANDS,
+              size=DEFAULT_SIZE, repeat=DEFAULT_REPEAT):
+    """Run each command on each workload, each in a new process.
+
+    Returns a dict describing the environment, with a list of results
+    of `run` under "results".
+    """
+    results = []
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for workload, command in itertools.product(workloads, commands):
+            results.append(pool.apply(
+                run, (model_filename, workload, command, size, repeat)
+            ))
+    return {
+        "model": os.path.abspath(model_filename),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "size": size,
+        "repeat": repeat,
+        "results": results,
+    }
@@ -0,0 +1,182 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Incremental scoring of edited texts, and a substitution cipher solver.
+#
+# Hill climbing over keys changes a few characters of the text at a time.
+# Only the n-grams containing a changed character are rescored, and then
+# the following ones until the backoff automaton gets to the same state
+# as before the change (usually right away).
+
+__all__ = ["ScoredText", "crack_substitution"]
+
+import collections
+import math
+import random
+
+
+class ScoredText(object):
+    """Text with the loss of each of its n-grams.
+
+    Changes are given as a dict of {position: new character}, positions
+    in the text as given (not decorated). `propose` scores them and
+    `accept` applies the last proposed ones.
+    """
+
+    def __init__(self, model, text):
+        self.model = model
+        self.order = order = model.order
+        decorated = model.decorate(text)
+        self.chars = list(decorated)
+        self.losses = []
+        self.states = [model.automaton.state_at(decorated, order - 1)]
+        state = self.states[0]
+        for char in self.chars[order - 1:]:
+            loss, state = state[char]
+            self.losses.append(loss)
+            self.states.append(state)
+        self.total = math.fsum(self.losses)
+        self._proposal = None
+
+    @property
+    def text(self):
+        return self.model.undecorate("".join(self.chars))
+
+    @property
+    def loss(self):
+        return self.total/len(self.losses)
+
+    def propose(self, changes):
+        """Return the change of the total loss if `changes` were made."""
+        order = self.order
+        chars = self.chars
+        losses = self.losses
+        states = self.states
+        count = len(losses)
+        new_chars = {
+            position + order - 1: char for position, char in changes.items()
+        }
+        positions = sorted(new_chars)
+        new_losses = {}
+        new_states = {}
+        delta = 0
+        i = 0
+        while i < len(positions):
+            # Rescore from the first n-gram containing a changed character
+            # on, until past the changes and back in the old state:
+            w = max(0, positions[i] - order + 1)
+            state = new_states.get(w, states[w])
+            last = -1
+            while w < count:
+                while i < len(positions) and positions[i] - order + 1 <= w:
+                    last = positions[i]
+                    i += 1
+                if w > last and state is states[w]:
+                    break
+                index = w + order - 1
+                loss, state = state[new_chars.get(index, chars[index])]
+                delta += loss - losses[w]
+                new_losses[w] = loss
+                w += 1
+                new_states[w] = state
+        self._proposal = (new_chars, new_losses, new_states, delta)
+        return delta
+
+    def accept(self):
+        """Apply the changes of the last `propose`."""
+        new_chars, new_losses, new_states, delta = self._proposal
+        self._proposal = None
+        for index, char in new_chars.items():
+            self.chars[index] = char
+        for w, loss in new_losses.items():
+            self.losses[w] = loss
+        for w, state in new_states.items():
+            self.states[w] = state
+        self.total += delta
+
+
+def crack_substitution(model, ciphertext, iterations=20000,
+                       temperature=4, restarts=10, seed=None):
+    """Search for the key of a simple substitution by simulated annealing.
+
+    Every character of `ciphertext` stands for a character of the model
+    alphabet (except newline), different characters for different ones.
+    Each iteration maps a cipher character to another letter, swapping
+    it with the character mapped there before, if any. A worse key is
+    accepted with the probability of exp(-delta/T), where delta is the
+    change of the total loss, and T decreases linearly from
+    `temperature` to zero.
+
+    Returns a list of (loss, plaintext, key) triples, the best of each
+    restart, sorted by loss. Raises ValueError for an empty ciphertext
+    or one with more characters than the model alphabet.
+    """
+    alphabet = sorted(
+        gram for gram in model.stats[-1] if len(gram) == 1 and gram != "\n"
+    )
+    symbols = sorted(set(ciphertext))
+    if not symbols:
+        raise ValueError("empty ciphertext")
+    if len(symbols) > len(alphabet):
+        raise ValueError("more cipher characters than model letters")
+    where = collections.defaultdict(list)
+    for position, symbol in enumerate(ciphertext):
+        where[symbol].append(position)
+    rng = random.Random(seed)
+
+    results = []
+    for _ in range(restarts):
+        images = rng.sample(alphabet, len(symbols))
+        key = dict(zip(symbols, images))
+        preimage = {letter: symbol for symbol, letter in key.items()}
+        scored = ScoredText(
+            model, "".join(key[symbol] for symbol in ciphertext)
+        )
+        best = (scored.total, dict(key))
+        for iteration in range(iterations):
+            symbol = rng.choice(symbols)
+            letter = rng.choice(alphabet)
+            old = key[symbol]
+            if letter == old:
+                continue
+            other = preimage.get(letter)
+            changes = {position: letter for position in where[symbol]}
+            if other is not None:
+                changes.update(
+                    (position, old) for position in where[other]
+                )
+            delta = scored.propose(changes)
+            t = temperature*(1 - iteration/iterations)
+            if delta > 0 and (t <= 0 or rng.random() >= math.exp(-delta/t)):
+                continue
+            scored.accept()
+            key[symbol] = letter
+            del preimage[old]
+            preimage[letter] = symbol
+            if other is not None:
+                key[other] = old
+                preimage[old] = other
+            if scored.total < best[0]:
+                best = (scored.total, dict(key))
+        key = best[1]
+        plaintext = "".join(key[symbol] for symbol in ciphertext)
+        results.append((
+            model.loss(model.decorate(plaintext)), plaintext, key
+        ))
+    results.sort(key=lambda result: result[0])
+    return results
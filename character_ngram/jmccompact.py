@@ -0,0 +1,144 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Compaction of `jmc.Jmc` models.
+#
+# An n-gram whose loss is close to the loss the model would back off to
+# without it can be dropped. The remaining losses can be quantized to
+# 2^8 or 2^16 evenly spaced values; the model file then stores small
+# integer codes with the lowest value and the spacing, and the loaded
+# model shares one float object per code.
+
+__all__ = ["prune", "quantize", "dump", "cross_entropy"]
+
+import gzip
+import json
+import math
+
+
+def _backoff_loss(stats, branch, gram):
+    """Loss `single_loss` would find for `gram` missing in `branch`."""
+    for k in range(branch + 1, len(stats)):
+        gram = gram[1:]
+        loss = stats[k].get(gram)
+        if loss is not None:
+            return loss
+    return None
+
+
+def _prune(stats, threshold, protected):
+    pruned = [None]*len(stats)
+    for branch in reversed(range(len(stats))):
+        pruned[branch] = {}
+        for gram, loss in stats[branch].items():
+            if len(gram) > 1 and gram not in protected:
+                backoff = _backoff_loss(pruned, branch, gram)
+                if backoff is not None and abs(loss - backoff) <= threshold:
+                    continue
+            pruned[branch][gram] = loss
+    return pruned
+
+
+def prune(stats, threshold):
+    """Drop n-grams whose loss differs from their backoff by at most
+    `threshold`, return the new stats.
+
+    Unigrams are always kept. Branches are pruned from the last one,
+    so that the backoff of an n-gram is the one of the pruned model.
+
+    Scoring gets to an n-gram only after matching its prefix at the
+    previous character, so prefixes of kept n-grams are kept as well
+    (in all branches). Keeping them changes the backoff of other
+    n-grams, so pruning is repeated until no more prefixes are needed.
+    """
+    protected = set()
+    while True:
+        pruned = _prune(stats, threshold, protected)
+        prefixes = {
+            gram[:-1] for branch in pruned for gram in branch
+            if len(gram) > 2
+        }
+        if prefixes <= protected:
+            return pruned
+        protected |= prefixes
+
+
+def quantize(stats, bits):
+    """Round losses to `2**bits` evenly spaced values.
+
+    Returns a pair of the lowest value and the spacing, and stats with
+    codes instead of losses; a code stands for lowest + code*spacing.
+    """
+    losses = [loss for branch in stats for loss in branch.values()]
+    low = min(losses, default=0)
+    high = max(losses, default=0)
+    levels = 2**bits - 1
+    step = (high - low)/levels or 1
+    codes = [
+        {gram: round((loss - low)/step) for gram, loss in branch.items()}
+        for branch in stats
+    ]
+    return (low, step), codes
+
+
+def dump(stats, fp, quantization=None):
+    """Write a model in a compact form, loadable by `jmc.Jmc.load`.
+
+    With `quantization` (as returned by `quantize`), `stats` are codes.
+    Minimum losses are stored as well, so that loading the model does
+    not search for them. Branches of a mapped model are copied to
+    dicts, to be written as JSON.
+    """
+    stats = [
+        branch if isinstance(branch, dict) else dict(branch)
+        for branch in stats
+    ]
+    min_values = [min(branch.values(), default=None) for branch in stats]
+    if quantization is not None:
+        low, step = quantization
+        min_values = [
+            None if code is None else low + code*step for code in min_values
+        ]
+    descriptor = {"stats": stats, "min_losses": [
+        math.inf if value is None else value for value in min_values
+    ]}
+    if quantization is not None:
+        descriptor["quantization"] = quantization
+    with gzip.open(fp, "wt", encoding="ascii") as zipfile:
+        json.dump(descriptor, zipfile, separators=(",", ":"), sort_keys=True)
+        zipfile.write("\n")
+
+
+def cross_entropy(model, lines):
+    """Mean loss per n-gram of `lines`, which are not decorated.
+
+    Raises ValueError for a line with a character the model does not
+    know, since its loss would be infinite.
+    """
+    alphabet = model.stats[-1]
+    total = 0
+    count = 0
+    for line in lines:
+        unknown = next((char for char in line if char not in alphabet), None)
+        if unknown is not None:
+            raise ValueError("{!r}: unknown character {!r}".format(
+                line, unknown
+            ))
+        total += sum(model.losses(model.decorate(line)))
+        count += len(line) + 1
+    return total/count if count else None
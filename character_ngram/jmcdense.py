@@ -0,0 +1,157 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Batched NumPy scoring on dense n-gram tables.
+#
+# Every backoff branch is turned into a flat array indexed by the n-gram
+# code in base len(alphabet), with NaN for n-grams not in the model.
+# A batch of lines is encoded into a 2D array of character codes, and
+# the `Jmc.single_loss` backoff chain is resolved for all lines at once,
+# one character position at a time.
+
+__all__ = ["DenseJmc"]
+
+import itertools
+
+import numpy
+
+import jmc
+
+# Alphabet characters are translated to code points starting here,
+# so that a single Latin-1 encoding both packs and validates them.
+_SHIFT = 128
+MAX_TABLE_SIZE = 2**26
+DEFAULT_BATCH_SIZE = 2**14
+
+
+class DenseJmc(jmc.Jmc):
+    def __init__(self, stats, min_losses=None, dtype=numpy.float64):
+        super().__init__(stats, min_losses)
+        order = self.order
+        self.alphabet = sorted(gram for gram in stats[-1] if len(gram) == 1)
+        base = self.base = len(self.alphabet)
+        if base > 256 - _SHIFT:
+            raise ValueError("alphabet too large for dense tables")
+        if base**order > MAX_TABLE_SIZE:
+            raise ValueError("model too large for dense tables")
+        self._translation = {
+            ord(char): _SHIFT + code
+            for code, char in enumerate(self.alphabet)
+        }
+
+        # offsets[m] is where the m-grams start in a flat table
+        self.offsets = [0, 0]
+        for m in range(1, order + 1):
+            self.offsets.append(self.offsets[-1] + base**m)
+        codes = {char: code for code, char in enumerate(self.alphabet)}
+        self.tables = []
+        for k, branch in enumerate(stats):
+            table = numpy.full(self.offsets[order - k + 1], numpy.nan, dtype)
+            for gram, loss in branch.items():
+                if not all(char in codes for char in gram):
+                    continue
+                index = 0
+                for char in gram:
+                    index = index*base + codes[char]
+                table[self.offsets[len(gram)] + index] = loss
+            self.tables.append(table)
+
+    def encode(self, lines):
+        """Encode lines into a 2D array of character codes.
+
+        Returns the codes, padded with zeros, and the length of each line.
+        """
+        data = [
+            line.translate(self._translation).encode("latin-1")
+            for line in lines
+        ]
+        lengths = numpy.fromiter(map(len, data), numpy.intp, len(data))
+        width = lengths.max(initial=0)
+        flat = numpy.frombuffer(b"".join(data), numpy.uint8)
+        if ((flat < _SHIFT) | (flat >= _SHIFT + self.base)).any():
+            raise ValueError("character not in model alphabet")
+        codes = numpy.zeros((len(data), width), numpy.uint8)
+        codes[numpy.arange(width) < lengths[:, None]] = flat - _SHIFT
+        return codes, lengths
+
+    def batch_loss(self, lines):
+        """Return an array with the loss of each line."""
+        order = self.order
+        codes, lengths = self.encode(lines)
+        rows, width = codes.shape
+
+        # indices[m][:, e] is the table index of the m-gram ending at e
+        unigrams = codes.astype(numpy.int64)
+        indices = numpy.zeros((order + 1, rows, width), numpy.int64)
+        indices[1] = unigrams
+        for m in range(2, order + 1):
+            indices[m, :, m - 1:] = (
+                indices[m - 1, :, m - 2:-1]*self.base + unigrams[:, m - 1:]
+            )
+        for m in range(2, order + 1):
+            indices[m] += self.offsets[m]
+
+        row_index = numpy.arange(rows)
+        result = numpy.zeros(rows)
+        prev_order = numpy.full(rows, order)
+        for end in range(order - 1, width):
+            skip = numpy.maximum(0, order - prev_order - 1)
+            loss = numpy.zeros(rows)
+            matched = prev_order.copy()
+            found = numpy.zeros(rows, bool)
+            for k, table in enumerate(self.tables):
+                m = order - k - skip
+                usable = (m >= 1) & ~found
+                if not usable.any():
+                    break
+                values = table[indices[numpy.maximum(m, 1), row_index, end]]
+                hit = usable & ~numpy.isnan(values)
+                loss[hit] = values[hit]
+                matched[hit] = m[hit]
+                found |= hit
+            valid = end < lengths
+            result[valid] += loss[valid]
+            prev_order[valid] = matched[valid]
+        return result/(lengths + 1 - order)
+
+    def iter_loss(self, lines, batch_size=DEFAULT_BATCH_SIZE):
+        """Yield pairs of (loss, line), scoring lines in batches."""
+        it = iter(lines)
+        while True:
+            batch = list(itertools.islice(it, batch_size))
+            if not batch:
+                return
+            yield from zip(self.batch_loss(batch).tolist(), batch)
+
+    def scored(self, lines, shared_prefix=False):
+        return self.iter_loss(lines)
+
+    def loss(self, line):
+        return self.batch_loss([line]).item()
+
+    def sort(self, lines, shared_prefix=False):
+        lines = list(lines)
+        order = numpy.argsort(self.batch_loss(lines), kind="stable")
+        return [lines[i] for i in order.tolist()]
+
+    def best(self, limit, lines, shared_prefix=False):
+        return [line for loss, line in self.nlargest(
+            limit, self.scored(lines),
+            key=lambda pair, top=numpy.inf: -pair[0],
+            counters=self.counters,
+        )]
@@ -0,0 +1,118 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Export of a trained `ngram_model.SmoothedNGramModel` to a `.jmc` file.
+#
+# The loss of an n-gram in backoff branch b is
+#
+#     -log(sum(lambdas[len + b:])/V + sum of lambda*single_prob of suffixes)
+#
+# where only the first term depends on the branch. The second term is
+# computed once for each n-gram, one order at a time, straight from the
+# counts. The n-grams are sorted like `jmc.Jmc.dump` sorts them (by
+# `extsort.esorted` if given a memory budget) and written to a temporary
+# file per branch, so that neither the dicts of the branches nor a dict
+# of all the n-grams are built.
+
+__all__ = ["dump"]
+
+import contextlib
+import gzip
+import json
+import math
+import shutil
+import tempfile
+
+from json.encoder import encode_basestring_ascii as encode_string
+
+import extsort
+
+BLANK = "\N{LOWER ONE EIGHTH BLOCK}"
+
+
+def interpolated_sums(model):
+    """Yield (gram, interpolated probability without the uniform term)
+    for the n-grams of all orders of `model`, one order at a time."""
+    lambdas = model.lambdas
+    for counts in model.counts:
+        for gram in counts:
+            yield gram, sum(
+                lambdas[len(gram) - k - 1]*model.single_prob(gram[k:])
+                for k in range(len(gram))
+            )
+
+
+def json_key(item):
+    """Sort key of a (gram, value) pair, like `json.dump(...,
+    sort_keys=True)` sorts the keys."""
+    return item[0].replace(BLANK, "\n")
+
+
+def dump(model, fp, memsize=None):
+    """Write `model` to `fp` in the format of `jmc.Jmc.dump`.
+
+    With `memsize`, the n-grams are sorted in temporary files using
+    about that many bytes of memory, otherwise in memory.
+    """
+    order = model.order
+    # The uniform term for n-grams of length n in branch b is at n + b:
+    uniform = [
+        sum(model.lambdas[n:])/model.vocab_size for n in range(2*order)
+    ]
+    if memsize is None:
+        sums = sorted(interpolated_sums(model), key=json_key)
+    else:
+        sums = extsort.esorted(interpolated_sums(model), key=json_key,
+                               memsize=memsize)
+
+    max_sums = [0]*(order + 1)
+    with contextlib.ExitStack() as stack:
+        branches = [
+            stack.enter_context(tempfile.TemporaryFile(
+                "w+", encoding="ascii"
+            ))
+            for branch in range(order)
+        ]
+        for gram, value in sums:
+            max_sums[len(gram)] = max(max_sums[len(gram)], value)
+            key = encode_string(gram.replace(BLANK, "\n"))
+            for branch in range(order - len(gram) + 1):
+                # Losses are finite, so their JSON is their repr:
+                loss = -math.log(uniform[len(gram) + branch] + value)
+                branches[branch].write(
+                    ",\n            " + key + ": " + repr(loss)
+                )
+
+        min_losses = [
+            min(-math.log(uniform[n + branch] + max_sums[n])
+                for n in range(1, order - branch + 1))
+            for branch in range(order)
+        ]
+        with gzip.open(fp, "wt", encoding="ascii") as zipfile:
+            zipfile.write('{\n    "min_losses": [\n        ')
+            zipfile.write(",\n        ".join(map(json.dumps, min_losses)))
+            zipfile.write('\n    ],\n    "stats": [')
+            for branch, entries in enumerate(branches):
+                zipfile.write("\n        {" if branch == 0 else ",\n        {")
+                # Each entry starts with a separator, the first one
+                # without the comma:
+                entries.seek(0)
+                if entries.read(1):
+                    shutil.copyfileobj(entries, zipfile)
+                zipfile.write("\n        }")
+            zipfile.write("\n    ]\n}\n")
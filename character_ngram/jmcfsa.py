@@ -0,0 +1,121 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Backoff automaton of a `jmc.Jmc` model.
+#
+# Scoring the next character depends only on the context the previous
+# n-gram was matched with: its last characters (at most order - 1 of
+# them) and its length, the `prev_order` of `Jmc.single_loss`. Such
+# a context is a state of the automaton. The transition of a state on
+# a character yields the loss of the character and the next state, so
+# scoring takes a single dict lookup per character, like following the
+# goto and failure links of Aho-Corasick at once.
+#
+# Transitions are resolved by `single_loss` on their first use and kept,
+# so only the part of the automaton the input walks through is built.
+# To bound the memory of each process (which matters namely with
+# a memory-mapped model shared by worker processes), all of it is
+# dropped once it has `max_transitions`, and built again as needed.
+
+__all__ = ["Automaton"]
+
+
+class State(dict):
+    """State of an automaton, a dict of transitions by character.
+
+    Each transition is a pair of (loss, next state).
+    """
+
+    def __init__(self, automaton, context, prev_order):
+        super().__init__()
+        self.automaton = automaton
+        self.context = context
+        self.prev_order = prev_order
+
+    def __missing__(self, char):
+        automaton = self.automaton
+        context = self.context + char
+        loss, matched = automaton.single_loss(
+            context.rjust(automaton.order, "\0"), self.prev_order
+        )
+        keep = min(matched, automaton.order - 1)
+        transition = (
+            loss, automaton.state(context[len(context) - keep:], matched)
+        )
+        if automaton.cache:
+            self[char] = transition
+            automaton.transitions += 1
+            if automaton.transitions > automaton.max_transitions:
+                automaton.clear()
+        return transition
+
+
+DEFAULT_MAX_TRANSITIONS = 2**18
+
+
+class Automaton(object):
+    # Class of the states, which subclasses may instrument:
+    state_class = State
+
+    def __init__(self, model, cache=True,
+                 max_transitions=DEFAULT_MAX_TRANSITIONS):
+        """Automaton scoring like `model.single_loss`.
+
+        Without `cache`, every transition is resolved again, so that the
+        calls of `single_loss` can be observed. With it, at most about
+        `max_transitions` are kept.
+        """
+        self.order = model.order
+        self.single_loss = model.single_loss
+        self.cache = cache
+        self.max_transitions = max_transitions
+        self.states = {}
+        self.transitions = 0
+
+    def clear(self):
+        """Drop all states and transitions.
+
+        States held by callers stay valid, only they are not shared
+        with the states created from now on. Other threads may keep
+        adding states and transitions meanwhile (as in `jmcserve`), so
+        the states are swapped for a new dict before the old ones are
+        cleared.
+        """
+        states = self.states
+        self.states = {}
+        self.transitions = 0
+        for state in list(states.values()):
+            state.clear()
+
+    def state(self, context, prev_order):
+        """Return the state after matching an n-gram of length
+        `prev_order` which ends with `context`."""
+        context = context[max(0, len(context) - prev_order):]
+        key = (context, prev_order)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = self.state_class(
+                self, context, prev_order
+            )
+        return state
+
+    def state_at(self, line, end, prev_order=None):
+        """Return the state for scoring `line` from position `end` on."""
+        if prev_order is None:
+            prev_order = self.order
+        return self.state(line[max(0, end - self.order + 1):end], prev_order)
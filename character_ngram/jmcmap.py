@@ -0,0 +1,198 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Memory-mapped binary format for the `stats` of a `jmc.Jmc` model.
+#
+# Each backoff branch is stored as a set of tables, one per byte length
+# of (UTF-8 encoded) n-grams. A table is a sorted array of fixed-width
+# keys followed by an array of float32 losses. Opening a model only
+# parses the header; lookups bisect the mapped keys, so no per-n-gram
+# Python objects are built and the pages are shared among processes.
+#
+# Since version 2, the header is followed by the minimum loss of each
+# branch, so that finding them does not read the whole file.
+
+__all__ = ["MAGIC", "dump", "load", "load_descriptor", "is_mapped"]
+
+import array
+import collections.abc
+import math
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"JMCM"
+VERSION = 2
+BYTEORDER = {"little": 0, "big": 1}
+
+_header = struct.Struct("<4sBBxxI")
+_branch = struct.Struct("<I")
+_table = struct.Struct("<III")
+
+
+class MappedBranch(collections.abc.Mapping):
+    def __init__(self, buffer, tables):
+        self.buffer = buffer
+        self.tables = {}
+        for width, count, offset in tables:
+            losses = _aligned(offset + width*count)
+            self.tables[width] = (offset, count, memoryview(buffer)[
+                losses:losses + 4*count
+            ].cast("f"))
+
+    def get(self, gram, default=None):
+        key = gram.encode("utf-8")
+        width = len(key)
+        table = self.tables.get(width)
+        if table is None:
+            return default
+        offset, count, losses = table
+        buffer = self.buffer
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi)//2
+            start = offset + mid*width
+            if buffer[start:start + width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = offset + lo*width
+        if lo < count and buffer[start:start + width] == key:
+            return losses[lo]
+        return default
+
+    def __getitem__(self, gram):
+        loss = self.get(gram)
+        if loss is None:
+            raise KeyError(gram)
+        return loss
+
+    def __contains__(self, gram):
+        return self.get(gram) is not None
+
+    def __len__(self):
+        return sum(count for offset, count, losses in self.tables.values())
+
+    def values(self):
+        for offset, count, losses in self.tables.values():
+            yield from losses
+
+    def __iter__(self):
+        for width, (offset, count, losses) in sorted(self.tables.items()):
+            for start in range(offset, offset + width*count, width):
+                yield self.buffer[start:start + width].decode("utf-8")
+
+
+def _aligned(pos, alignment=4):
+    return pos + -pos % alignment
+
+
+def _align(fp, start):
+    pos = fp.tell() - start
+    fp.write((_aligned(pos) - pos)*b"\0")
+
+
+def dump(stats, fp, min_losses=None):
+    """Write `stats` of a `jmc.Jmc` model in the mapped format.
+
+    `fp` has to be a seekable binary file. `min_losses` of the branches
+    are computed unless given.
+    """
+    if min_losses is None:
+        min_losses = [
+            min(branch.values(), default=math.inf) for branch in stats
+        ]
+    start = fp.tell()
+    tables = []
+    for branch in stats:
+        by_width = collections.defaultdict(list)
+        for gram, loss in branch.items():
+            key = gram.encode("utf-8")
+            by_width[len(key)].append((key, loss))
+        tables.append(sorted(by_width.items()))
+
+    fp.write(_header.pack(
+        MAGIC, VERSION, BYTEORDER[sys.byteorder], len(stats)
+    ))
+    array.array("f", min_losses).tofile(fp)
+    index_pos = fp.tell()
+    for branch_tables in tables:
+        fp.write(_branch.pack(len(branch_tables)))
+        fp.write(len(branch_tables)*_table.pack(0, 0, 0))
+
+    index = []
+    for branch_tables in tables:
+        branch_index = []
+        for width, items in branch_tables:
+            items.sort()
+            _align(fp, start)
+            branch_index.append((width, len(items), fp.tell() - start))
+            fp.write(b"".join(key for key, loss in items))
+            _align(fp, start)
+            array.array("f", (loss for key, loss in items)).tofile(fp)
+        index.append(branch_index)
+
+    end = fp.tell()
+    fp.seek(index_pos)
+    for branch_index in index:
+        fp.write(_branch.pack(len(branch_index)))
+        for table in branch_index:
+            fp.write(_table.pack(*table))
+    fp.seek(end)
+
+
+def is_mapped(filename):
+    """Tell whether `filename` is a model in the mapped format."""
+    if not isinstance(filename, (str, bytes, os.PathLike)):
+        return False
+    with open(filename, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def load(filename):
+    """Map a model file into memory and return its `stats`."""
+    return load_descriptor(filename)["stats"]
+
+
+def load_descriptor(filename):
+    """Map a model file into memory and return the keyword arguments of
+    `jmc.Jmc` for it."""
+    with open(filename, "rb") as fp:
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, byteorder, order = _header.unpack_from(buffer)
+    if magic != MAGIC or version not in (1, VERSION):
+        raise ValueError("{}: not a mapped jmc model".format(filename))
+    if byteorder != BYTEORDER[sys.byteorder]:
+        raise ValueError("{}: byte order mismatch".format(filename))
+    pos = _header.size
+    min_losses = None
+    if version >= 2:
+        min_losses = memoryview(buffer)[pos:pos + 4*order].cast("f").tolist()
+        pos += 4*order
+    stats = []
+    for branch in range(order):
+        (count,) = _branch.unpack_from(buffer, pos)
+        pos += _branch.size
+        tables = list(_table.iter_unpack(
+            buffer[pos:pos + count*_table.size]
+        ))
+        pos += count*_table.size
+        stats.append(MappedBranch(buffer, tables))
+    return {"stats": stats, "min_losses": min_losses}
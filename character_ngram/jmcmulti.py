@@ -0,0 +1,134 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Scoring with several models in a single pass.
+#
+# Lines are scored in chunks, one model at a time, so that no more
+# models are loaded than the pool keeps. Each line is normalized once,
+# and its n-grams are extracted once for all models of the same kind
+# and order. Besides `jmc.Jmc` models, the
+# bigram models of `bigram_model/bicount.py` are supported, so that all
+# the city models can be compared at once.
+
+__all__ = ["BigramModel", "load_model", "models", "multi_loss"]
+
+import itertools
+import marshal
+import math
+
+import jmc
+import jmcmap
+import resourceman
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CHUNKSIZE = 2**14
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class BigramModel(object):
+    """Model of `bigram_model/bicount.py`, scoring like `bisort.py`."""
+    order = 2
+
+    def __init__(self, statistics):
+        self.statistics = statistics
+
+    @classmethod
+    def load(cls, fp):
+        with open(fp, "rb") as f:
+            return cls(marshal.load(f))
+
+    def ngrams(self, line):
+        return [line[k:k + 2] for k in range(len(line) - 1)]
+
+    def ngram_loss(self, ngrams):
+        if not ngrams:
+            return math.inf
+        # Unknown bigrams are infinitely unlikely, like unknown n-grams
+        # of `jmc.Jmc`:
+        statistics = self.statistics
+        return sum(
+            statistics.get(bigram, math.inf) for bigram in ngrams
+        )/len(ngrams)
+
+    def loss(self, line):
+        return self.ngram_loss(self.ngrams(line))
+
+
+def load_model(filename):
+    """Load a model of any supported format."""
+    with open(filename, "rb") as fp:
+        magic = fp.read(max(len(jmcmap.MAGIC), len(GZIP_MAGIC)))
+    if magic.startswith(jmcmap.MAGIC) or magic.startswith(GZIP_MAGIC):
+        return jmc.Jmc.load(filename)
+    return BigramModel.load(filename)
+
+
+# Least recently used models, kept loaded:
+models = resourceman.ResourcePool(
+    maxsize=DEFAULT_POOL_SIZE,
+    claim_cb=load_model,
+    free_cb=lambda filename, model: None,
+)
+
+
+def multi_loss(filenames, lines, normalize=None, pool=models,
+               chunksize=DEFAULT_CHUNKSIZE):
+    """Score each line with each of the models.
+
+    Parameters
+    ----------
+    filenames : Sequence[str]
+        Model files, loaded through `pool`.
+    lines : Iterable[str]
+        Input lines, not decorated.
+    normalize : Callable[[str], str], optional
+        Function applied to each line before scoring, like `jmc.Jmc.latin`.
+    pool : resourceman.ResourcePool, optional
+        Pool of loaded models. Lines are scored in chunks, by one model
+        at a time, so only the models kept by the pool stay loaded.
+    chunksize : int, optional
+        Number of lines scored by a model at once.
+
+    Returns
+    -------
+    Iterable[List[float]]
+        Losses of each line, one per model.
+    """
+    columns = list(enumerate(filenames))
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunksize))
+        if not chunk:
+            return
+        if normalize is not None:
+            chunk = [normalize(line) for line in chunk]
+        rows = [[None]*len(columns) for line in chunk]
+        # N-grams of the chunk, by the kind of model extracting them:
+        ngrams = {}
+        for column, filename in columns:
+            model = pool[filename]
+            kind = (type(model), model.order)
+            if kind not in ngrams:
+                ngrams[kind] = [model.ngrams(line) for line in chunk]
+            for row, line_ngrams in zip(rows, ngrams[kind]):
+                row[column] = model.ngram_loss(line_ngrams)
+            del model
+        yield from rows
+        # Start the next chunk with the models used last, which the pool
+        # is the most likely to keep:
+        columns.reverse()
@@ -0,0 +1,149 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Scoring in a pool of worker processes.
+#
+# Input lines (not decorated) are split into chunks, each worker loads
+# the model once and scores whole chunks. The results are merged so
+# that the output is the same as from the single-process `Jmc` methods.
+
+__all__ = ["loss", "scored", "sort", "best"]
+
+import collections
+import functools
+import heapq
+import itertools
+import multiprocessing
+import operator
+
+DEFAULT_CHUNKSIZE = 2**14
+
+_model = None
+_first = operator.itemgetter(0)
+
+
+def _init_worker(loader, filename):
+    global _model
+    _model = loader(filename)
+
+
+def _score(lines, shared_prefix):
+    decorated = [_model.decorate(line) for line in lines]
+    if hasattr(_model, "batch_loss"):
+        return _model.batch_loss(decorated).tolist()
+    if shared_prefix:
+        return list(_model.prefix_losses(decorated))
+    return [_model.loss(line) for line in decorated]
+
+
+def _loss_task(lines, shared_prefix):
+    return _score(lines, shared_prefix)
+
+
+def _scored_task(lines, shared_prefix):
+    return list(zip(_score(lines, shared_prefix), lines))
+
+
+def _sort_task(lines, shared_prefix):
+    if shared_prefix:
+        lines.sort()
+    return sorted(zip(_score(lines, shared_prefix), lines), key=_first)
+
+
+def _best_task(lines, shared_prefix, limit):
+    decorated = (_model.decorate(line) for line in lines)
+    top = _model.best(limit, decorated, shared_prefix=shared_prefix)
+    return [(_model.loss(line), _model.undecorate(line)) for line in top]
+
+
+def _chunks(lines, chunksize):
+    it = iter(lines)
+    while True:
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _imap(task, loader, filename, lines, jobs, chunksize):
+    """Like `Pool.imap`, but reads input only a few chunks ahead."""
+    with multiprocessing.Pool(
+            jobs, initializer=_init_worker, initargs=(loader, filename),
+    ) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(lines, chunksize):
+            pending.append(pool.apply_async(task, (chunk,)))
+            if len(pending) > 2*jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def loss(loader, filename, lines, jobs,
+         shared_prefix=False, chunksize=DEFAULT_CHUNKSIZE):
+    """Yield loss of each line, in input order.
+
+    Parameters
+    ----------
+    loader : Callable[[str], jmc.Jmc]
+        Function loading the model in workers, like `jmc.Jmc.load`.
+    filename : str
+        Model file.
+    lines : Iterable[str]
+        Input lines, not decorated.
+    jobs : int
+        Number of worker processes.
+    shared_prefix : bool, optional
+        Reuse work on prefixes shared by consecutive lines of a chunk.
+    chunksize : int, optional
+        Number of lines sent to a worker at once.
+    """
+    task = functools.partial(_loss_task, shared_prefix=shared_prefix)
+    for losses in _imap(task, loader, filename, lines, jobs, chunksize):
+        yield from losses
+
+
+def scored(loader, filename, lines, jobs,
+           shared_prefix=False, chunksize=DEFAULT_CHUNKSIZE):
+    """Yield pairs of (loss, line), in input order; see `loss`."""
+    task = functools.partial(_scored_task, shared_prefix=shared_prefix)
+    for pairs in _imap(task, loader, filename, lines, jobs, chunksize):
+        yield from pairs
+
+
+def sort(loader, filename, lines, jobs,
+         shared_prefix=False, chunksize=DEFAULT_CHUNKSIZE):
+    """Yield lines sorted by loss; see `loss` for parameters."""
+    task = functools.partial(_sort_task, shared_prefix=shared_prefix)
+    runs = list(_imap(task, loader, filename, lines, jobs, chunksize))
+    for line_loss, line in heapq.merge(*runs, key=_first):
+        yield line
+
+
+def best(loader, filename, limit, lines, jobs,
+         shared_prefix=False, chunksize=DEFAULT_CHUNKSIZE):
+    """Return `limit` lines with the lowest loss; see `loss`."""
+    task = functools.partial(
+        _best_task, shared_prefix=shared_prefix, limit=limit
+    )
+    top = []
+    for chunk_top in _imap(task, loader, filename, lines, jobs, chunksize):
+        top = list(itertools.islice(
+            heapq.merge(top, chunk_top, key=_first), limit
+        ))
+    return [line for line_loss, line in top]
@@ -0,0 +1,373 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Branch-and-bound search for the best texts in a permutation space.
+#
+# A text is a sequence of pieces, each computed from the values assigned
+# to a few variables. Variables are assigned in the order the pieces
+# need them, so the text grows from the left and its loss is computed
+# incrementally. A partial text is abandoned once even the cheapest
+# possible rest cannot bring it among the best candidates found so far.
+#
+# For texts where each position is one of a few candidates, there is also
+# a beam search over the lattice of candidates.
+
+__all__ = [
+    "Piece", "search",
+    "word_space", "grid_space", "parse_space",
+    "beam_search", "parse_lattice",
+]
+
+import collections
+import heapq
+import math
+
+
+class Piece(collections.namedtuple("Piece", ["deps", "fn", "max_length"])):
+    """Part of the text computed as `fn(*values_of_deps)`.
+
+    The function returns a string of at most `max_length` characters,
+    or None if the assignment yields no valid candidate.
+    """
+
+    def __new__(cls, deps, fn, max_length=1):
+        return super().__new__(cls, tuple(deps), fn, max_length)
+
+
+def search(model, limit, variables, values, pieces, distinct=True):
+    """Find texts with the lowest loss in a space of assignments.
+
+    Parameters
+    ----------
+    model : jmc.Jmc
+        Model to score the texts with.
+    limit : int
+        Number of texts to return.
+    variables : Sequence[Hashable]
+        Variables to be assigned.
+    values : Sequence[Any]
+        Values to be assigned to the variables.
+    pieces : Sequence[Piece]
+        Pieces the text consists of, in order.
+    distinct : bool, optional
+        Whether each value may be used only once, i.e. whether the
+        assignments are permutations (the default) or combinations
+        with repetition.
+
+    Returns
+    -------
+    List[Tuple[float, str]]
+        Pairs of loss and text, sorted by loss. Each text is listed
+        only once.
+    """
+    if distinct and len(values) < len(variables):
+        raise ValueError("not enough values for distinct variables")
+    order = model.order
+    min_loss = min(model.min_losses)
+
+    # Assign only variables used by pieces, in the order of first use,
+    # and emit each piece as soon as it and all pieces before it can be:
+    known = set(variables)
+    used = []
+    emit_at = collections.defaultdict(list)
+    depth = -1
+    for i, piece in enumerate(pieces):
+        for dep in piece.deps:
+            if dep not in known:
+                raise ValueError("unknown variable {!r}".format(dep))
+            if dep not in used:
+                used.append(dep)
+            depth = max(depth, used.index(dep))
+        emit_at[depth].append(i)
+    max_rest = [0]
+    for piece in reversed(pieces):
+        max_rest.append(max_rest[-1] + piece.max_length)
+    max_rest.reverse()
+
+    assignment = {}
+    free = [True]*len(values)
+    top = []
+    texts = set()
+    found = 0
+
+    def extend(depth, line):
+        for i in emit_at[depth]:
+            piece = pieces[i]
+            text = piece.fn(*(assignment[dep] for dep in piece.deps))
+            if text is None:
+                return None
+            line += text
+        return line
+
+    def threshold():
+        return -top[0][0] if len(top) >= limit else math.inf
+
+    def finish(line, total, prev_order):
+        nonlocal found
+        line += "\n"
+        total, prev_order = model.partial_loss(
+            line, len(line) - order, total, prev_order
+        )
+        loss = total/(len(line) + 1 - order)
+        text = model.undecorate(line)
+        if loss >= threshold() or text in texts:
+            return
+        found += 1
+        texts.add(text)
+        if len(top) >= limit:
+            texts.discard(heapq.heapreplace(top, (-loss, -found, text))[2])
+        else:
+            heapq.heappush(top, (-loss, -found, text))
+
+    def visit(depth, line, total, prev_order, emitted):
+        if depth == len(used):
+            finish(line, total, prev_order)
+            return
+        children = []
+        for index, value in enumerate(values):
+            if not free[index]:
+                continue
+            assignment[used[depth]] = value
+            child = extend(depth, line)
+            if child is None:
+                continue
+            child_total, child_prev_order = model.partial_loss(
+                child, len(line) - order + 1, total, prev_order
+            )
+            child_emitted = emitted + len(emit_at[depth])
+            # The final loss is a mean, which is the lowest when the rest
+            # of the text is as long as possible and as cheap as possible:
+            done = len(child) - order + 1
+            count = len(child) - order + 2 + max_rest[child_emitted]
+            bound = (child_total + min_loss*(count - done))/count
+            children.append((
+                bound, index, child, child_total, child_prev_order,
+                child_emitted,
+            ))
+        children.sort(key=lambda child: child[0])
+        for bound, index, child, child_total, child_prev_order, \
+                child_emitted in children:
+            # Slightly relaxed, so that rounding never prunes a text
+            # which would make it below the threshold:
+            if bound > threshold()*(1 + 1e-9):
+                break
+            assignment[used[depth]] = values[index]
+            if distinct:
+                free[index] = False
+            visit(depth + 1, child, child_total, child_prev_order,
+                  child_emitted)
+            free[index] = True
+
+    if limit > 0:
+        line = extend(-1, model.decorate("")[:-1])
+        if line is not None:
+            total, prev_order = model.partial_loss(line)
+            visit(0, line, total, prev_order, len(emit_at[-1]))
+    return [(-loss, text) for loss, found, text in sorted(top, reverse=True)]
+
+
+def word_space(words, picks):
+    """Space of permuted words, like in puzzles where the solution is
+    read letter by letter from words put into the right order.
+
+    `picks` are pairs of (slot, index): the next letter of the text is
+    the `index`-th letter of the word put into `slot` (both 0-based).
+    Returns `variables`, `values` and `pieces` for `search`.
+    """
+    def pick_letter(index):
+        return lambda word: word[index] if index < len(word) else None
+
+    variables = range(len(words))
+    pieces = [Piece((slot,), pick_letter(index)) for slot, index in picks]
+    return variables, words, pieces
+
+
+def grid_space(symbols, grid, picks):
+    """Space of permuted symbols indexing rows and columns of a grid.
+
+    `picks` are pairs of symbols: the next piece of the text is the cell
+    in the row given by the position of the first symbol and the column
+    given by the position of the second one.
+    Returns `variables`, `values` and `pieces` for `search`.
+    """
+    def pick_cell(row, column):
+        try:
+            return grid[row][column]
+        except IndexError:
+            return None
+
+    max_length = max((len(cell) for row in grid for cell in row), default=0)
+    pieces = [Piece(pick, pick_cell, max_length) for pick in picks]
+    return symbols, range(len(symbols)), pieces
+
+
+def parse_space(lines, normalize=lambda text: text):
+    """Parse description of a space for the `jmc search` command.
+
+    Each line starts with a keyword followed by whitespace-separated
+    values; repeated keywords extend the values. Empty lines and lines
+    starting with `#` are ignored. Either of the two spaces is accepted:
+
+    words WORD...
+    pick SLOT:INDEX...
+        See `word_space`, but with 1-based SLOT and INDEX.
+
+    symbols SYMBOLS...
+    grid ROW...
+    pick SYMBOLSYMBOL...
+        See `grid_space`. Each symbol is a single character. Each
+        character of ROW is a cell, unless ROW contains commas, which
+        then separate the cells.
+
+    repeat
+        Values can repeat, the default is to permute them.
+
+    Strings from the text are passed through `normalize`.
+    Returns `variables`, `values`, `pieces` and `distinct` for `search`.
+    """
+    spec = collections.defaultdict(list)
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        keyword, *args = line.split()
+        spec[keyword].extend(args)
+    unknown = spec.keys() - {"words", "pick", "symbols", "grid", "repeat"}
+    if unknown:
+        raise ValueError("unknown keywords: {}".format(", ".join(unknown)))
+    distinct = "repeat" not in spec
+
+    if "words" in spec:
+        try:
+            picks = [
+                tuple(int(number) - 1 for number in pick.split(":"))
+                for pick in spec["pick"]
+            ]
+        except ValueError:
+            raise ValueError("picks have to be in the form SLOT:INDEX")
+        words = [normalize(word) for word in spec["words"]]
+        # Any of the words can be put into a slot, so an index is valid
+        # if it is within the longest one:
+        max_length = max(map(len, words), default=0)
+        if not all(len(pick) == 2 and 0 <= pick[0] < len(words)
+                   and 0 <= pick[1] < max_length
+                   for pick in picks):
+            raise ValueError("picks have to be in the form SLOT:INDEX")
+        return (*word_space(words, picks), distinct)
+
+    if "symbols" in spec:
+        symbols = "".join(spec["symbols"])
+        grid = [
+            [normalize(cell) for cell in
+             (row.split(",") if "," in row else row)]
+            for row in spec["grid"]
+        ]
+        if not all(len(pick) == 2 and set(pick) <= set(symbols)
+                   for pick in spec["pick"]):
+            raise ValueError("picks have to be pairs of symbols")
+        return (*grid_space(symbols, grid, spec["pick"]), distinct)
+
+    raise ValueError("either words or symbols have to be given")
+
+
+def beam_search(model, limit, lattice, width=None):
+    """Find texts with the lowest loss in a lattice of candidates.
+
+    Hypotheses which end in the same context (the same length, last
+    characters and backoff state) score the same from there on, so only
+    the `limit` best of them are kept. Without `width`, this is exact
+    (a k-best Viterbi search). Otherwise, only `width` hypotheses with
+    the lowest mean loss are kept after each position.
+
+    Parameters
+    ----------
+    model : jmc.Jmc
+        Model to score the texts with.
+    limit : int
+        Number of texts to return.
+    lattice : Sequence[Sequence[str]]
+        Candidate strings for each position of the text.
+    width : int, optional
+        Beam width.
+
+    Returns
+    -------
+    List[Tuple[float, str]]
+        Pairs of loss and text, sorted by loss.
+    """
+    order = model.order
+    context = order - 1
+    start = model.decorate("")[:-1]
+    # Hypotheses are tuples of (total, line, prev_order):
+    hypotheses = [(0, start, order)]
+    for candidates in lattice:
+        states = collections.defaultdict(dict)
+        for total, line, prev_order in hypotheses:
+            for candidate in candidates:
+                child = line + candidate
+                child_total, child_prev_order = model.partial_loss(
+                    child, len(line) - context, total, prev_order
+                )
+                state = states[
+                    len(child), child[len(child) - context:], child_prev_order
+                ]
+                if child not in state:
+                    state[child] = (child_total, child, child_prev_order)
+        hypotheses = [
+            hypothesis for state in states.values()
+            for hypothesis in heapq.nsmallest(limit, state.values())
+        ]
+        if width is not None and len(hypotheses) > width:
+            hypotheses = heapq.nsmallest(
+                width, hypotheses,
+                key=lambda hypothesis: hypothesis[0]/(
+                    len(hypothesis[1]) - context or 1
+                ),
+            )
+
+    results = []
+    for total, line, prev_order in hypotheses:
+        line += "\n"
+        total, prev_order = model.partial_loss(
+            line, len(line) - order, total, prev_order
+        )
+        results.append(
+            (total/(len(line) + 1 - order), model.undecorate(line))
+        )
+    return heapq.nsmallest(limit, results)
+
+
+def parse_lattice(lines, normalize=lambda text: text):
+    """Parse a lattice for the `jmc beam` command.
+
+    Each line lists candidates for one position of the text. Candidates
+    are separated by whitespace or commas; if there are no separators,
+    each character is a candidate. Empty lines are ignored. Candidates
+    are passed through `normalize`.
+    """
+    lattice = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if any(char.isspace() or char == "," for char in line):
+            candidates = line.replace(",", " ").split()
+        else:
+            candidates = line
+        lattice.append(list(dict.fromkeys(map(normalize, candidates))))
+    return lattice
@@ -0,0 +1,201 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Scoring server keeping models loaded, and its client.
+#
+# The protocol is line based, in UTF-8. The client sends a JSON object
+# with the request on the first line, for example
+#
+#     {"command": "best", "model": "/path/to/model.jmc", "limit": 10}
+#
+# followed by the input lines, and shuts down its side of the socket.
+# Each line of the response starts with a character telling its type:
+# "=" for a line of output, "!" for an error message, and "." marks the
+# successful end of the response.
+
+__all__ = ["ServerError", "ModelCache", "serve", "request"]
+
+import errno
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import jmc
+
+
+class ServerError(Exception):
+    pass
+
+
+class ModelCache(object):
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get(self, filename, dense=False):
+        key = (os.path.abspath(filename), dense)
+        with self.lock:
+            model = self.models.get(key)
+            if model is None:
+                if dense:
+                    import jmcdense
+                    model = jmcdense.DenseJmc.load(filename)
+                else:
+                    model = jmc.Jmc.load(filename)
+                self.models[key] = model
+            return model
+
+
+def _loss(model, request, lines):
+    scored = model.scored(
+        lines, shared_prefix=request.get("shared_prefix", False)
+    )
+    for loss, line in scored:
+        yield str(loss)
+
+
+def _sort(model, request, lines):
+    for line in model.sort(
+            lines, shared_prefix=request.get("shared_prefix", False)):
+        yield model.undecorate(line)
+
+
+def _best(model, request, lines):
+    for line in model.best(
+            int(request["limit"]), lines,
+            shared_prefix=request.get("shared_prefix", False)):
+        yield model.undecorate(line)
+
+
+COMMANDS = {
+    "loss": _loss,
+    "sort": _sort,
+    "best": _best,
+}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        rfile = (line.decode("utf-8").rstrip("\n") for line in self.rfile)
+        header = next(rfile, None)
+        if header is None:
+            # A connection probing whether the server runs, see
+            # `Server.server_bind`.
+            return
+        try:
+            request = json.loads(header)
+            command = COMMANDS[request["command"]]
+            model = self.server.models.get(
+                request["model"], request.get("dense", False)
+            )
+            lines = (model.decorate(line) for line in rfile)
+            for line in command(model, request, lines):
+                self.wfile.write("={}\n".format(line).encode("utf-8"))
+        except Exception as err:
+            message = "{}: {}".format(type(err).__name__, err)
+            self.wfile.write(
+                "!{}\n".format(message.replace("\n", " ")).encode("utf-8")
+            )
+            # Read the rest of input, lest the client gets a reset
+            # connection before reading the message:
+            try:
+                self.wfile.flush()
+                for line in self.rfile:
+                    pass
+            except OSError:
+                pass
+        else:
+            self.wfile.write(b".\n")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        try:
+            super().server_bind()
+        except OSError as err:
+            if err.errno != errno.EADDRINUSE:
+                raise
+            # A socket file left behind by a server that crashed accepts
+            # no connections, it can be replaced:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.server_address)
+                except ConnectionRefusedError:
+                    pass
+                else:
+                    raise ServerError("{}: a server is already running"
+                                      .format(self.server_address)) from err
+            os.unlink(self.server_address)
+            super().server_bind()
+
+
+def serve(path, filenames=()):
+    """Serve requests on Unix domain socket `path` until interrupted.
+
+    Models in `filenames` are loaded in advance, any other models are
+    loaded on first use. All of them are kept in memory.
+    """
+    models = ModelCache()
+    for filename in filenames:
+        models.get(filename)
+    with Server(path, RequestHandler) as server:
+        server.models = models
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def request(path, header, lines):
+    """Send a request to the server at `path`, yield output lines.
+
+    `header` is the request object, see the module description, and
+    `lines` are input lines, not decorated.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+
+        def send():
+            try:
+                with sock.makefile("wb") as fp:
+                    fp.write(json.dumps(header).encode("utf-8") + b"\n")
+                    for line in lines:
+                        fp.write(line.encode("utf-8") + b"\n")
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                # The server has closed the connection, it tells why.
+                pass
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        with sock.makefile("rb") as fp:
+            for line in fp:
+                line = line.decode("utf-8").rstrip("\n")
+                kind, text = line[:1], line[1:]
+                if kind == "=":
+                    yield text
+                elif kind == ".":
+                    sender.join()
+                    return
+                else:
+                    raise ServerError(text)
+        raise ServerError("connection closed unexpectedly")
@@ -0,0 +1,164 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Opt-in statistics of a scoring run.
+#
+# Nothing is measured unless a `Stats` object is attached: `instrument`
+# gives a single model instance a backoff automaton counting its
+# transitions, still cached like in an ordinary run, and the other
+# methods wrap the input and output of a command. Uninstrumented models
+# and commands run the same code as before.
+
+__all__ = ["Stats"]
+
+import collections
+import contextlib
+import json
+import time
+
+import jmcfsa
+
+
+class CountingState(jmcfsa.State):
+    """State counting the transitions taken, their backoff depths and
+    misses of the transition cache."""
+
+    def __getitem__(self, char):
+        transition = super().__getitem__(char)
+        automaton = self.automaton
+        automaton.counters["transitions"] += 1
+        automaton.backoff[automaton.order - transition[1].prev_order] += 1
+        return transition
+
+    def __missing__(self, char):
+        self.automaton.counters["cache_misses"] += 1
+        return super().__missing__(char)
+
+
+class CountingAutomaton(jmcfsa.Automaton):
+    state_class = CountingState
+
+    def __init__(self, model, stats):
+        super().__init__(model)
+        self.counters = stats.counters
+        self.backoff = stats.backoff
+
+
+class Stats(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        # Seconds spent in each stage:
+        self.stages = collections.Counter()
+        self.counters = collections.Counter()
+        # Number of n-grams scored by the backoff depth, i.e. the number
+        # of characters the matched n-gram is shorter than the model order:
+        self.backoff = collections.Counter()
+        self.sizes = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def timed(self, name, iterable):
+        """Yield from `iterable`, counting the time and items as `name`."""
+        it = iter(iterable)
+        stages = self.stages
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                stages[name] += clock() - start
+                return
+            stages[name] += clock() - start
+            self.counters[name] += 1
+            yield item
+
+    def print_lines(self, lines):
+        """Print lines, counting the time of printing as output."""
+        stages = self.stages
+        clock = time.perf_counter
+        for line in lines:
+            start = clock()
+            print(line)
+            stages["output"] += clock() - start
+
+    def instrument(self, model):
+        """Attach to `model`, recording its backoff depths, hits and
+        misses of the transition cache, heap replacements of `best` and
+        sizes of its tables."""
+        model.automaton = CountingAutomaton(model, self)
+        model.counters = self.counters
+        self.sizes = [len(branch) for branch in model.stats]
+        return model
+
+    def report(self):
+        """Return the statistics as a JSON-serializable dict."""
+        total = time.perf_counter() - self.start
+        stages = dict(self.stages)
+        stages["score"] = max(0, total - sum(stages.values()))
+        stages["total"] = total
+        lines = self.counters["input"]
+        misses = self.counters["cache_misses"]
+        return {
+            "stages": stages,
+            "lines": lines,
+            "lines_per_second": lines/total if total else None,
+            "backoff_depth": {
+                str(depth): count
+                for depth, count in sorted(self.backoff.items())
+            },
+            "cache_hits": self.counters["transitions"] - misses,
+            "cache_misses": misses,
+            "heap_replacements": self.counters["heap_replacements"],
+            "model_sizes": self.sizes,
+        }
+
+    def dump(self, fp, as_json=False):
+        report = self.report()
+        if as_json:
+            json.dump(report, fp, indent=2)
+            print(file=fp)
+            return
+        for stage, seconds in report["stages"].items():
+            print("{:<8}{:>12.3f} s".format(stage, seconds), file=fp)
+        print("lines   {:>12} ({:.0f} lines/s)".format(
+            report["lines"], report["lines_per_second"] or 0
+        ), file=fp)
+        scored = sum(self.backoff.values())
+        for depth, count in report["backoff_depth"].items():
+            print("backoff depth {}: {} ({:.1%})".format(
+                depth, count, count/scored
+            ), file=fp)
+        if self.counters["transitions"]:
+            print("transition cache: {} hits, {} misses".format(
+                report["cache_hits"], report["cache_misses"]
+            ), file=fp)
+        if self.counters["heap_replacements"]:
+            print("heap replacements: {}".format(
+                report["heap_replacements"]
+            ), file=fp)
+        if self.sizes is not None:
+            print("model n-grams per branch: {}".format(
+                " ".join(map(str, self.sizes))
+            ), file=fp)
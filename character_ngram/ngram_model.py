@@ -1,15 +1,33 @@
+import array
+import io
+import itertools
+import locale
 import logging
 import math
+import mmap
+import multiprocessing
+import os
 import pickle
+import tempfile
 
 from collections import Counter
+from collections.abc import Mapping
 from warnings import warn
 
+import extsort
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
                     level=logging.INFO, datefmt='%H:%M:%S')
 logger = logging.getLogger(__name__)
 LOG_EVERY=10000
+# Approximate memory taken by a Counter entry besides its characters:
+COUNTER_ENTRY_SIZE = 100
 
 
 def update_counts(counts, tokens, order):
@@ -35,6 +53,192 @@ def total(counter):
     return sum(counter.values())
 
 
+def regular_filename(data):
+    """Return the name of the regular file `data` reads, or None."""
+    filename = getattr(data, "name", data)
+    if isinstance(filename, str) and os.path.isfile(filename):
+        return filename
+    return None
+
+
+def read_shard(filename, start, end, encoding):
+    """Yield lines of the file which start in bytes [start, end).
+
+    Lines are decoded as in text mode, with universal newlines.
+    """
+    with open(filename, "rb") as f:
+        if start > 0:
+            # Skip the line started in the previous shard, if any:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            text = line.decode(encoding)
+            if "\r" in text:
+                yield from io.StringIO(text, newline=None)
+            else:
+                yield text
+
+
+def spill_counts(data, order, memsize, preprocess=None):
+    """Yield (ngram, count) pairs of n-grams of all orders in `data`.
+
+    Counts are accumulated in memory and yielded whenever they would
+    take more than about `memsize` bytes, so an n-gram may be yielded
+    several times, with partial counts.
+    """
+    counts = Counter()
+    size = 0
+
+    for i, line in enumerate(data):
+        if preprocess is not None:
+            line = preprocess(line)
+
+        for n in range(order):
+            for j in range(len(line) - n):
+                ngram = line[j:j + n + 1]
+                if ngram not in counts:
+                    size += COUNTER_ENTRY_SIZE + len(ngram)
+                counts[ngram] += 1
+
+        if size > memsize:
+            logger.info("Spilling %d n-grams", len(counts))
+            yield from counts.items()
+            counts.clear()
+            size = 0
+
+        if i > 0 and i % LOG_EVERY == 0:
+            logger.info("%d lines loaded", i)
+
+    yield from counts.items()
+
+
+def count_external(data, order, memsize, preprocess=None):
+    """Yield (ngram, count) pairs of n-grams of all orders in `data`,
+    sorted by length and then by the n-gram.
+
+    Partial counts are sorted by `extsort.esorted` and summed as they
+    are merged, using about `memsize` bytes of memory besides the
+    temporary files.
+    """
+    pairs = extsort.esorted(
+        spill_counts(data, order, memsize // 2, preprocess),
+        key=lambda pair: (len(pair[0]), pair[0]),
+        memsize=memsize // 2,
+    )
+    for ngram, group in itertools.groupby(pairs, key=lambda pair: pair[0]):
+        yield ngram, sum(count for _, count in group)
+
+
+class MappedCounts(Mapping):
+    """Counts of n-grams of length `n`, in memory-mapped temporary files.
+
+    `pairs` of (ngram, count) have to be sorted by the n-gram. Like
+    a Counter, the counts give 0 for missing n-grams. The n-grams are
+    stored in UTF-32, so that they have a fixed width and lookups can
+    bisect them; they are iterated in sorted order.
+    """
+
+    ENCODING = "utf-32-be"
+    BATCH_SIZE = 4096
+
+    def __init__(self, n, pairs):
+        self.width = 4 * n
+        pairs = iter(pairs)
+        with tempfile.TemporaryFile() as keys, \
+                tempfile.TemporaryFile() as counts:
+            while True:
+                batch = list(itertools.islice(pairs, self.BATCH_SIZE))
+                if not batch:
+                    break
+                keys.write("".join(ngram for ngram, _ in batch)
+                           .encode(self.ENCODING))
+                counts.write(array.array("q", (count for _, count in batch))
+                             .tobytes())
+            keys.flush()
+            counts.flush()
+            self.length = counts.tell() // 8
+            if self.length:
+                self.ngram_data = mmap.mmap(keys.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                self.count_data = memoryview(mmap.mmap(
+                    counts.fileno(), 0, access=mmap.ACCESS_READ)).cast("q")
+            else:
+                self.ngram_data = b""
+                self.count_data = array.array("q")
+
+    def get(self, ngram, default=None):
+        key = ngram.encode(self.ENCODING)
+        width = self.width
+        if len(key) != width:
+            return default
+        data = self.ngram_data
+        lo = 0
+        hi = self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[mid * width:(mid + 1) * width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.length and data[lo * width:(lo + 1) * width] == key:
+            return self.count_data[lo]
+        return default
+
+    def __getitem__(self, ngram):
+        return self.get(ngram, 0)
+
+    def __contains__(self, ngram):
+        return self.get(ngram) is not None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        width = self.width
+        for start in range(0, self.length * width, width):
+            yield self.ngram_data[start:start + width].decode(self.ENCODING)
+
+    def values(self):
+        return iter(self.count_data)
+
+    def items(self):
+        return zip(self, self.count_data)
+
+    def __reduce__(self):
+        # Pickled, e.g. in a saved model, as an ordinary Counter:
+        return Counter, (dict(self.items()),)
+
+
+_preprocess = None
+
+
+def _init_worker(preprocess):
+    global _preprocess
+    _preprocess = preprocess
+
+
+def _count_shard(task):
+    index, filename, start, end, encoding, order = task
+    counts = [Counter() for _ in range(order)]
+
+    for i, line in enumerate(read_shard(filename, start, end, encoding)):
+        if _preprocess is not None:
+            line = _preprocess(line)
+
+        update_counts(counts, line, order)
+
+        if i > 0 and i % LOG_EVERY == 0:
+            logger.info("Shard %d: %d lines loaded", index, i)
+
+    logger.info("Shard %d done", index)
+    return counts
+
+
 class SmoothedNGramModel:
 
     def __init__(self, order):
@@ -90,7 +294,25 @@ class SmoothedNGramModel:
 
         return interpolated_prob
 
-    def heldout_xent(self):
+    def heldout_matrix(self):
+        # Single probabilities of the heldout n-grams, one row per n-gram,
+        # in the order of lambdas, and the frequencies of the n-grams.
+        # They depend only on the counts, so EM computes them once.
+        ngrams = self.heldout_counts[self.order - 1]
+        probs = numpy.array([
+            [self.single_prob(ngram[self.order - n - 1:])
+             for n in range(self.order)]
+            for ngram in ngrams
+        ], dtype=numpy.float64).reshape(len(ngrams), self.order)
+        freqs = numpy.fromiter(ngrams.values(), numpy.float64, len(ngrams))
+        return probs, freqs
+
+    def heldout_xent(self, matrix=None):
+        if numpy is not None:
+            probs, freqs = matrix or self.heldout_matrix()
+            xent = freqs @ numpy.log(probs @ numpy.array(self.lambdas))
+            return - xent / freqs.sum()
+
         xent = 0.0
         for ngram, freq in self.heldout_counts[self.order - 1].items():
             xent += freq * math.log(self.interpolated_prob(ngram))
@@ -120,20 +342,80 @@ class SmoothedNGramModel:
 
         return counts
 
-    def train(self, train_data, preprocess=None):
+    def _load_shards(self, filename, jobs, encoding, preprocess=None):
+        # Shards are merged in order, so that the n-grams are inserted
+        # in the order of first occurrence like in _load_data
+        # (preprocess is passed to the workers, so it has to be picklable
+        # unless the processes are forked, e.g. not a lambda)
+        size = os.path.getsize(filename)
+        tasks = [
+            (k, filename, size * k // jobs, size * (k + 1) // jobs,
+             encoding, self.order)
+            for k in range(jobs)
+        ]
+        logger.info("Counting %d shards in %d processes", jobs, jobs)
+
+        counts = [Counter() for _ in range(self.order)]
+        with multiprocessing.Pool(jobs, initializer=_init_worker,
+                                  initargs=(preprocess,)) as pool:
+            for shard_counts in pool.imap(_count_shard, tasks):
+                for n in range(self.order):
+                    counts[n].update(shard_counts[n])
+
+        return counts
+
+    def _load_external(self, data, memsize, preprocess=None):
+        # The sorted stream is consumed one order at a time into mapped
+        # tables, so the counts take no memory of their own. Unlike the
+        # other ways of counting, the n-grams are in sorted order rather
+        # than in the order of first occurrence.
+        counts = [MappedCounts(n + 1, ()) for n in range(self.order)]
+
+        pairs = count_external(data, self.order, memsize, preprocess)
+        for n, group in itertools.groupby(pairs,
+                                          key=lambda pair: len(pair[0])):
+            counts[n - 1] = MappedCounts(n, group)
+
+        return counts
+
+    def _load(self, data, preprocess=None, jobs=1, memsize=None):
+        if memsize is not None:
+            if jobs > 1:
+                logger.warning("Counting with a memory budget "
+                               "in a single process")
+            return self._load_external(data, memsize, preprocess)
+
+        if jobs > 1:
+            filename = regular_filename(data)
+            if filename is not None:
+                encoding = (getattr(data, "encoding", None)
+                            or locale.getpreferredencoding(False))
+                return self._load_shards(filename, jobs, encoding, preprocess)
+            logger.warning("Input is not a regular file, "
+                           "counting in a single process")
+
+        return self._load_data(data, preprocess)
+
+    def train(self, train_data, preprocess=None, jobs=1, memsize=None):
         if self.trained:
             warn("Model already trained, overwriting", RuntimeWarning)
 
-        self.counts = self._load_data(train_data, preprocess)
+        self.counts = self._load(train_data, preprocess, jobs, memsize)
         self.totals = [total(self.counts[n]) for n in range(self.order)]
         self.vocab_size = len(self.counts[0])
 
-    def heldout(self, heldout_data, preprocess=None):
-        self.heldout_counts = self._load_data(heldout_data, preprocess)
+    def heldout(self, heldout_data, preprocess=None, jobs=1, memsize=None):
+        self.heldout_counts = self._load(heldout_data, preprocess, jobs,
+                                         memsize)
         self.heldout_totals = [
             total(self.heldout_counts[n]) for n in range(self.order)]
 
-    def lambda_expectation(self):
+    def lambda_expectation(self, matrix=None):
+        if numpy is not None:
+            probs, freqs = matrix or self.heldout_matrix()
+            weighted = probs * numpy.array(self.lambdas)
+            return ((freqs / weighted.sum(axis=1)) @ weighted).tolist()
+
         lambda_counts = [0 for _ in range(self.order)]
         for ngram, freq in self.heldout_counts[self.order - 1].items():
             prob = self.interpolated_prob(ngram)
@@ -154,16 +436,18 @@ class SmoothedNGramModel:
 
         dist = lambda x, y: sum(abs(xi - yi) for xi, yi in zip(x, y))
 
+        matrix = self.heldout_matrix() if numpy is not None else None
+
         while dist(self.lambdas, prev_lambdas) > epsilon:
             iteration += 1
 
-            lambda_counts = self.lambda_expectation()
+            lambda_counts = self.lambda_expectation(matrix)
             prev_lambdas = self.lambdas
 
             self.lambda_update(lambda_counts)
 
             if iteration % valid_every == 0:
-                current_xent = self.heldout_xent()
+                current_xent = self.heldout_xent(matrix)
 
                 logger.info("Iteration %d, heldout cross-entropy: %.6f",
                             iteration, current_xent)
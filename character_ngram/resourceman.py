@@ -52,6 +52,8 @@ class ConnectedList(ConnectedListEntry):
 
     def swap(self, previous):
         current = previous.next
+        if current is self.last:
+            return
         previous.next = current.next
         current.next = None
         self.extend(current)
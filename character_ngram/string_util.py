@@ -1,15 +1,14 @@
-import re
-import unicodedata
+import textnorm
 
-nonalpha = re.compile("[^a-zA-Z]")
 BLANK = "\N{LOWER ONE EIGHTH BLOCK}"
 
 
 def preprocess(line, normalize, lowercase, add_blanks, order):
-    if normalize:
-        line = nonalpha.sub("", unicodedata.normalize("NFKD", line))
-
-    if lowercase:  # check for bugs, lower was inside nonalpha.sub
+    if normalize and lowercase:
+        line = textnorm.LATIN(line)
+    elif normalize:
+        line = textnorm.LETTERS(line)
+    elif lowercase:
         line = line.lower()
 
     if add_blanks:
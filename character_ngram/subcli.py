@@ -48,7 +48,9 @@ class Subcommand(object):
                 .format(
                     argv[0],
                     "\n".join(
-                        "   {{:<{}}}{{}}".format(width).format(cmd, fn.__doc__)
+                        "   {{:<{}}}{{}}".format(width).format(
+                            cmd, fn.__doc__.split("\n", 1)[0]
+                        )
                         for cmd, fn in sorted(self.commands.items())
                     )
                 )
@@ -0,0 +1,881 @@
+#!/usr/bin/env python3
+
+import collections
+import functools
+import gzip
+import heapq
+import io
+import itertools
+import marshal
+import math
+import multiprocessing
+import operator
+import os
+import pickle
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import extsort
+import jmc
+import jmcbench
+import jmccipher
+import jmccompact
+import jmcexport
+import jmcfsa
+import jmcmap
+import jmcmulti
+import jmcpool
+import jmcsearch
+import jmcserve
+import jmcstats
+import ngram_model
+import resourceman
+import string_util
+import textnorm
+
+try:
+    import jmcdense
+except ImportError:
+    jmcdense = None
+
+MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "praha4.jmc")
+
+
+class JmcTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = jmc.Jmc.load(MODEL)
+
+    def decorated(self, words):
+        return [self.model.decorate(word) for word in words]
+
+
+class TestSharedPrefix(JmcTestCase):
+    def test_prefix_losses(self):
+        lines = self.decorated(
+            "".join(p) for p in itertools.permutations("ostrava", 5)
+        )
+        self.assertEqual(
+            list(self.model.prefix_losses(lines)),
+            [self.model.loss(line) for line in lines],
+        )
+
+    def test_prefix_losses_unsorted(self):
+        lines = self.decorated(["vinohrady", "a", "vinor", "", "vino"])
+        self.assertEqual(
+            list(self.model.prefix_losses(lines)),
+            [self.model.loss(line) for line in lines],
+        )
+
+    def test_sort(self):
+        lines = self.decorated(["zzxq", "praha", "qqq", "vinohrady"])
+        self.assertEqual(
+            self.model.sort(lines, shared_prefix=True),
+            self.model.sort(lines),
+        )
+
+    def test_best(self):
+        lines = self.decorated(
+            sorted("".join(p) for p in itertools.permutations("karlin"))
+        )
+        self.assertEqual(
+            self.model.best(5, iter(lines), shared_prefix=True),
+            self.model.best(5, iter(lines)),
+        )
+
+    def test_best_list(self):
+        lines = self.decorated(
+            ["vinohrady", "ostrava", "karlin", "qxqzzj", "zzzzzz"]
+        )
+        self.assertEqual(
+            self.model.best(3, lines), self.model.sort(lines)[:3]
+        )
+
+
+class TestAutomaton(JmcTestCase):
+    def reference_losses(self, line, prev_order):
+        order = self.model.order
+        for k in range(len(line) - order + 1):
+            loss, prev_order = self.model.single_loss(
+                line[k:k + order], prev_order
+            )
+            yield loss, prev_order
+
+    def test_losses(self):
+        lines = self.decorated(
+            ["", "a", "praha", "vinohrady", "qxqzzj", "karlinkarlin"]
+        )
+        for line in lines:
+            expected = list(self.reference_losses(line, self.model.order))
+            self.assertEqual(
+                list(self.model.losses(line)),
+                [loss for loss, prev_order in expected],
+            )
+            self.assertEqual(
+                self.model.partial_loss(line),
+                (sum(loss for loss, prev_order in expected),
+                 expected[-1][1]),
+            )
+
+    def test_resume(self):
+        line = self.model.decorate("smichovskenadrazi")
+        order = self.model.order
+        for prev_order in range(1, order + 1):
+            total = 1.5
+            for loss, expected in self.reference_losses(line[5:], prev_order):
+                total += loss
+            self.assertEqual(
+                self.model.partial_loss(line, 5, 1.5, prev_order),
+                (total, expected),
+            )
+
+    def test_bounded(self):
+        lines = self.decorated(["praha", "vinohrady", "qxqzzj", "karlin"])
+        model = jmc.Jmc(**self.model.get_descriptor())
+        model.automaton = jmcfsa.Automaton(model, max_transitions=10)
+        for line in lines:
+            self.assertEqual(list(model.losses(line)),
+                             list(self.model.losses(line)))
+        self.assertLessEqual(model.automaton.transitions, 10)
+
+    def test_bounded_threads(self):
+        lines = self.decorated(
+            "".join(p) for p in itertools.permutations("karlin", 4)
+        )
+        expected = [list(self.model.losses(line)) for line in lines]
+        model = jmc.Jmc(**self.model.get_descriptor())
+        model.automaton = jmcfsa.Automaton(model, max_transitions=50)
+        results = []
+
+        def score():
+            results.append([list(model.losses(line)) for line in lines])
+
+        threads = [threading.Thread(target=score) for _ in range(4)]
+        # Switch threads often, so that they clear the automaton while
+        # others use it:
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(results, 4*[expected])
+
+
+class TestCipher(JmcTestCase):
+    def test_propose(self):
+        scored = jmccipher.ScoredText(self.model, "vinohradskanamestimiru")
+        for changes in [{0: "z"}, {3: "a", 4: "b"}, {2: "x", 15: "q"},
+                        {20: "w"}, {5: "h"}]:
+            text = list(scored.text)
+            for position, char in changes.items():
+                text[position] = char
+            text = "".join(text)
+            expected = sum(self.model.losses(self.model.decorate(text)))
+            delta = scored.propose(changes)
+            self.assertAlmostEqual(scored.total + delta, expected)
+            scored.accept()
+            self.assertEqual(scored.text, text)
+            self.assertAlmostEqual(
+                scored.loss, self.model.loss(self.model.decorate(text))
+            )
+
+    def test_crack_substitution(self):
+        plaintext = "vinohradskanamestimirukarlovonamestiletenskamalostranske"
+        ciphertext = plaintext.translate(str.maketrans(
+            "abcdefghijklmnopqrstuvwxyz", "qwertyuiopasdfghjklzxcvbnm"
+        ))
+        results = jmccipher.crack_substitution(
+            self.model, ciphertext, restarts=3, seed=1
+        )
+        self.assertEqual(results[0][1], plaintext)
+        with self.assertRaises(ValueError):
+            jmccipher.crack_substitution(self.model, "")
+
+
+class TestCompact(JmcTestCase):
+    def test_prune(self):
+        stats = self.model.stats
+        self.assertEqual(jmccompact.prune(stats, -1), stats)
+        pruned = jmccompact.prune(stats, math.inf)
+        self.assertTrue(all(len(gram) == 1
+                            for branch in pruned for gram in branch))
+        pruned = jmccompact.prune(stats, 0.1)
+        self.assertLess(sum(map(len, pruned)), sum(map(len, stats)))
+        # Prefixes of kept n-grams are kept, so that they can be reached:
+        kept = {gram for branch in pruned for gram in branch}
+        for gram in kept:
+            for branch, original in zip(pruned, stats):
+                if gram[:-1] in original:
+                    self.assertIn(gram[:-1], branch)
+        lines = ["praha", "karlin", "vinohrady"]
+        self.assertAlmostEqual(
+            jmccompact.cross_entropy(jmc.Jmc(pruned), lines),
+            jmccompact.cross_entropy(self.model, lines),
+            places=1,
+        )
+
+    def test_quantize(self):
+        quantization, codes = jmccompact.quantize(self.model.stats, 8)
+        low, step = quantization
+        self.assertTrue(all(0 <= code < 256
+                            for branch in codes for code in branch.values()))
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "model.jmc")
+            jmccompact.dump(codes, filename, quantization)
+            model = jmc.Jmc.load(filename)
+        self.assertEqual(
+            model.min_losses, [min(branch.values()) for branch in model.stats]
+        )
+        for branch, original in zip(model.stats, self.model.stats):
+            self.assertEqual(branch.keys(), original.keys())
+            for gram, loss in branch.items():
+                self.assertLessEqual(
+                    abs(loss - original[gram]), step/2 + 1e-9
+                )
+
+    def test_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "model.jmb")
+            with open(filename, "wb") as fp:
+                self.model.dump_mapped(fp)
+            mapped = jmc.Jmc.load(filename)
+            compact = os.path.join(tmp, "model.jmc")
+            jmccompact.dump(mapped.stats, compact)
+            model = jmc.Jmc.load(compact)
+        for branch, original in zip(model.stats, mapped.stats):
+            self.assertEqual(branch, dict(original))
+
+    def test_cross_entropy_unknown(self):
+        with self.assertRaises(ValueError):
+            jmccompact.cross_entropy(self.model, ["praha", "Hlavní"])
+
+
+class TestBranchAndBound(JmcTestCase):
+    def test_iloss(self):
+        for line in self.decorated(["praha", "qxqzzj", "a"]):
+            loss = self.model.loss(line)
+            self.assertEqual(self.model.iloss(line), loss)
+            self.assertEqual(self.model.iloss(line, loss + 1e-6), loss)
+            self.assertEqual(self.model.iloss(line, loss/2), math.inf)
+
+    def test_best(self):
+        lines = self.decorated(
+            "".join(p) for p in itertools.permutations("vinohrady", 5)
+        )
+        self.assertEqual(
+            self.model.best(10, iter(lines)),
+            self.model.sort(lines)[:10],
+        )
+
+
+class TestSearch(JmcTestCase):
+    def brute_force(self, limit, variables, values, pieces, distinct):
+        if distinct:
+            assignments = itertools.permutations(values, len(variables))
+        else:
+            assignments = itertools.product(values, repeat=len(variables))
+        texts = set()
+        for assignment in assignments:
+            assignment = dict(zip(variables, assignment))
+            parts = [
+                piece.fn(*(assignment[dep] for dep in piece.deps))
+                for piece in pieces
+            ]
+            if None not in parts:
+                texts.add("".join(parts))
+        return [
+            self.model.undecorate(line)
+            for line in self.model.sort(self.decorated(sorted(texts)))
+        ][:limit]
+
+    def check(self, limit, space):
+        self.assertEqual(
+            [text for loss, text in
+             jmcsearch.search(self.model, limit, *space)],
+            self.brute_force(limit, *space),
+        )
+
+    def test_words(self):
+        space = jmcsearch.parse_space([
+            "words vinohrady karlin ostrava praha",
+            "pick 1:2 2:2 3:3 4:1 1:3",
+            "pick 2:4 3:6",
+        ])
+        self.check(5, space)
+        self.check(1, space)
+
+    def test_grid(self):
+        space = jmcsearch.parse_space([
+            "# Polybius square",
+            "symbols abc d",
+            "grid abcd efgh ijkl m,n,o,ch",
+            "pick ab cd da bb ac",
+        ])
+        self.check(7, space)
+
+    def test_repeat(self):
+        space = jmcsearch.parse_space([
+            "words ab cde f",
+            "pick 1:1 2:2 3:1 2:1",
+            "repeat",
+        ])
+        self.check(10, space)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            jmcsearch.parse_space(["words a b", "pick 3:1"])
+        with self.assertRaises(ValueError):
+            jmcsearch.parse_space(["words ab cd", "pick 1:0"])
+        with self.assertRaises(ValueError):
+            jmcsearch.parse_space(["words ab cd", "pick 1:3"])
+        with self.assertRaises(ValueError):
+            jmcsearch.parse_space(["symbols ab", "grid ab", "pick ax"])
+        with self.assertRaises(ValueError):
+            jmcsearch.parse_space(["letters ab"])
+
+
+class TestBeamSearch(JmcTestCase):
+    lattice = jmcsearch.parse_lattice([
+        "pqr", "a b r", "", "aeo", "h,g,k,ch", "aou", "ou",
+    ])
+
+    def brute_force(self, limit):
+        texts = sorted(set(map("".join, itertools.product(*self.lattice))))
+        return [
+            (self.model.loss(line), self.model.undecorate(line))
+            for line in self.model.sort(self.decorated(texts))
+        ][:limit]
+
+    def test_exact(self):
+        self.assertEqual(
+            jmcsearch.beam_search(self.model, 10, self.lattice),
+            self.brute_force(10),
+        )
+
+    def test_width(self):
+        results = jmcsearch.beam_search(
+            self.model, 3, self.lattice, width=50
+        )
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results, sorted(results))
+        self.assertLessEqual(
+            len(jmcsearch.beam_search(self.model, 5, self.lattice, 2)), 2
+        )
+
+
+class TestServer(JmcTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "jmc.sock")
+        self.server = jmcserve.Server(self.path, jmcserve.RequestHandler)
+        self.server.models = jmcserve.ModelCache()
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def request(self, lines, **header):
+        return list(jmcserve.request(
+            self.path, {"model": MODEL, **header}, lines
+        ))
+
+    def test_commands(self):
+        words = ["praha", "qxqzzj", "vinohrady", "karlin"]
+        lines = self.decorated(words)
+        self.assertEqual(
+            self.request(words, command="loss"),
+            [str(self.model.loss(line)) for line in lines],
+        )
+        self.assertEqual(
+            self.request(words, command="sort"),
+            list(map(self.model.undecorate, self.model.sort(lines))),
+        )
+        self.assertEqual(
+            self.request(words, command="best", limit=2),
+            list(map(
+                self.model.undecorate, self.model.best(2, iter(lines))
+            )),
+        )
+
+    def test_bind(self):
+        with self.assertRaises(jmcserve.ServerError):
+            jmcserve.Server(self.path, jmcserve.RequestHandler)
+
+        # A socket file nothing listens on is replaced:
+        path = os.path.join(self.tempdir.name, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+        with jmcserve.Server(path, jmcserve.RequestHandler) as server:
+            self.assertEqual(server.server_address, path)
+
+    def test_errors(self):
+        with self.assertRaises(jmcserve.ServerError):
+            self.request(["praha"], command="unknown")
+        with self.assertRaises(jmcserve.ServerError):
+            self.request(["Praha"] * 10000, command="loss")
+
+
+class TestMultiLoss(JmcTestCase):
+    def test_multi_loss(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            bigram_model = os.path.join(tempdir, "bigram.model")
+            statistics = {
+                a + b: float(ord(a) - ord(b))
+                for a in "abcdefghijklmnopqrstuvwxyz"
+                for b in "abcdefghijklmnopqrstuvwxyz"
+            }
+            with open(bigram_model, "wb") as fp:
+                marshal.dump(statistics, fp)
+            pool = resourceman.ResourcePool(
+                maxsize=1,
+                claim_cb=jmcmulti.load_model,
+                free_cb=lambda filename, model: None,
+            )
+            results = list(jmcmulti.multi_loss(
+                [MODEL, bigram_model, MODEL], ["Praha", "Hlavní", "x"],
+                normalize=jmc.Jmc.latin, pool=pool,
+            ))
+
+        self.assertEqual([row[0] for row in results], [
+            self.model.loss(line)
+            for line in self.decorated(["praha", "hlavni", "x"])
+        ])
+        self.assertEqual([row[2] for row in results],
+                         [row[0] for row in results])
+        self.assertEqual(
+            [row[1] for row in results],
+            [
+                sum(ord(a) - ord(b) for a, b in zip(word, word[1:]))
+                / (len(word) - 1)
+                for word in ["praha", "hlavni"]
+            ] + [math.inf],
+        )
+
+    def test_bounded(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            bigram_model = os.path.join(tempdir, "bigram.model")
+            with open(bigram_model, "wb") as fp:
+                marshal.dump({"ab": 1.0, "bc": 2.0}, fp)
+            loaded = []
+            pool = resourceman.ResourcePool(
+                maxsize=1,
+                claim_cb=lambda filename: loaded.append(filename) or
+                jmcmulti.load_model(filename),
+                free_cb=lambda filename, model: None,
+            )
+            results = list(jmcmulti.multi_loss(
+                [bigram_model, MODEL], ["abc", "abx", "praha"],
+                pool=pool, chunksize=2,
+            ))
+
+        # Without normalization, unknown bigrams are infinitely unlikely:
+        self.assertEqual([row[0] for row in results],
+                         [1.5, math.inf, math.inf])
+        self.assertEqual(results[2][1], self.model.loss(
+            self.decorated(["praha"])[0]
+        ))
+        # The second chunk starts with the model loaded last:
+        self.assertEqual(loaded, [bigram_model, MODEL, bigram_model])
+
+
+class TestExternalSort(JmcTestCase):
+    def test_esort(self):
+        lines = self.decorated(
+            "".join(p) for p in itertools.permutations("ostrava", 4)
+        )
+        calls = []
+
+        class CountingJmc(jmc.Jmc):
+            def loss(self, line):
+                calls.append(line)
+                return super().loss(line)
+
+        model = CountingJmc(**self.model.get_descriptor())
+        self.assertEqual(
+            list(model.esort(lines, memsize=0, filesize=2**10)),
+            self.model.sort(lines),
+        )
+        self.assertEqual(len(calls), len(lines))
+
+    def test_parallel(self):
+        items = [(i*7919 % 1009, str(i)) for i in range(5000)]
+        for key in (None, operator.itemgetter(0)):
+            self.assertEqual(
+                list(extsort.esorted(items, key=key, memsize=0,
+                                     filesize=2**12, jobs=3)),
+                sorted(items, key=key),
+            )
+
+    def test_codecs(self):
+        items = [(i*7919 % 1009, "x"*(i % 50)) for i in range(3000)]
+        for codec in extsort.CODECS:
+            for compresslevel in (0, 1):
+                self.assertEqual(
+                    list(extsort.esorted(items, memsize=0, filesize=2**12,
+                                         compresslevel=compresslevel,
+                                         codec=codec)),
+                    sorted(items),
+                )
+
+    def test_store_keys(self):
+        items = [str(i*7919 % 1009) for i in range(3000)]
+        calls = []
+
+        def key(item):
+            calls.append(item)
+            return item[::-1]
+
+        self.assertEqual(
+            list(extsort.esorted(items, key=key, memsize=0, filesize=2**10,
+                                 nofile=3, store_keys=True)),
+            sorted(items, key=lambda item: item[::-1]),
+        )
+        self.assertEqual(len(calls), len(items))
+
+    def test_unique_count_limit(self):
+        items = [str(i*7919 % 101) for i in range(3000)]
+        expected = sorted(set(items))
+        counts = collections.Counter(items)
+        for memsize in (0, 2**20):
+            kwargs = dict(memsize=memsize, filesize=2**9, nofile=3)
+            self.assertEqual(
+                list(extsort.esorted(items, unique=True, **kwargs)),
+                expected,
+            )
+            self.assertEqual(
+                list(extsort.esorted(items, count=True, **kwargs)),
+                [(item, counts[item]) for item in expected],
+            )
+            self.assertEqual(
+                list(extsort.esorted(items, key=len, unique=True,
+                                     limit=2, **kwargs)),
+                ["0", "41"],
+            )
+            self.assertEqual(
+                list(extsort.esorted(items, limit=5, **kwargs)),
+                sorted(items)[:5],
+            )
+
+    def test_merge_passes(self):
+        items = [(i*7919 % 101, str(i)) for i in range(5000)]
+        with unittest.mock.patch("builtins.open", wraps=open) as mock_open:
+            result = list(extsort.esorted(
+                items, key=operator.itemgetter(0), memsize=0,
+                filesize=2**10, nofile=4,
+            ))
+        self.assertEqual(result, sorted(items, key=operator.itemgetter(0)))
+        reads = [call for call in mock_open.call_args_list
+                 if call.args[1:] == ("rb",)]
+        # Each temporary file is opened once (initial and merged ones):
+        self.assertEqual(len(reads), len(set(call.args[0] for call in reads)))
+
+    def test_merge_fanin(self):
+        items = [i*7919 % 9973 for i in range(9000)]
+        for nofile in (3, 4, 17):
+            with unittest.mock.patch.object(
+                    extsort.heapq, "merge", wraps=heapq.merge) as merge:
+                result = list(extsort.esorted(
+                    items, memsize=0, filesize=2**10, nofile=nofile,
+                ))
+            self.assertEqual(result, sorted(items))
+            fanins = [len(call.args) for call in merge.call_args_list]
+            # Intermediate merges of nofile - 1 buckets, never just one:
+            self.assertTrue(all(2 <= fanin < nofile for fanin in fanins[:-1]))
+            self.assertLessEqual(fanins[-1], nofile)
+
+
+class TestMapped(JmcTestCase):
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "model.jmb")
+            with open(filename, "wb") as fp:
+                self.model.dump_mapped(fp)
+            self.assertTrue(jmcmap.is_mapped(filename))
+            self.assertFalse(jmcmap.is_mapped(MODEL))
+            mapped = jmc.Jmc.load(filename)
+
+        self.assertEqual(mapped.order, self.model.order)
+        self.assertEqual(
+            mapped.min_losses,
+            [min(branch.values()) for branch in mapped.stats],
+        )
+        for branch, mapped_branch in zip(self.model.stats, mapped.stats):
+            self.assertEqual(set(branch), set(mapped_branch))
+            for gram, loss in branch.items():
+                self.assertAlmostEqual(mapped_branch[gram], loss, places=5)
+            self.assertIsNone(mapped_branch.get("qqqq"))
+            self.assertIsNone(mapped_branch.get("\u0159"))
+
+        for line in self.decorated(["praha", "vinohrady", "qxq"]):
+            self.assertAlmostEqual(
+                mapped.loss(line), self.model.loss(line), places=5
+            )
+
+
+class TestPool(JmcTestCase):
+    words = ["".join(p) for p in itertools.permutations("karlin", 4)]
+
+    def test_loss(self):
+        self.assertEqual(
+            list(jmcpool.loss(
+                jmc.Jmc.load, MODEL, self.words, 2, chunksize=50,
+            )),
+            [self.model.loss(line) for line in self.decorated(self.words)],
+        )
+
+    def test_sort(self):
+        self.assertEqual(
+            list(jmcpool.sort(
+                jmc.Jmc.load, MODEL, self.words, 2, chunksize=50,
+            )),
+            [
+                self.model.undecorate(line)
+                for line in self.model.sort(self.decorated(self.words))
+            ],
+        )
+
+    def test_best(self):
+        self.assertEqual(
+            jmcpool.best(
+                jmc.Jmc.load, MODEL, 7, self.words, 2, chunksize=50,
+            ),
+            [
+                self.model.undecorate(line)
+                for line in self.model.best(
+                    7, iter(self.decorated(self.words))
+                )
+            ],
+        )
+
+
+@unittest.skipUnless(jmcdense, "requires numpy")
+class TestDense(JmcTestCase):
+    def test_batch_loss(self):
+        dense = jmcdense.DenseJmc(**self.model.get_descriptor())
+        lines = self.decorated(
+            ["", "a", "praha", "vinohrady", "qxqzzj", "karlin"]
+            + ["".join(p) for p in itertools.permutations("ostrava", 4)]
+        )
+        for dense_loss, line in zip(dense.batch_loss(lines), lines):
+            self.assertAlmostEqual(dense_loss, self.model.loss(line))
+        self.assertEqual(dense.sort(lines), self.model.sort(lines))
+        self.assertEqual(
+            dense.best(3, iter(lines)), self.model.best(3, iter(lines))
+        )
+
+    def test_unknown_character(self):
+        dense = jmcdense.DenseJmc(**self.model.get_descriptor())
+        with self.assertRaises(ValueError):
+            dense.batch_loss(self.decorated(["praha", "Praha"]))
+        with self.assertRaises(ValueError):
+            dense.batch_loss(self.decorated(["\u0159"]))
+
+
+class TestBench(unittest.TestCase):
+    def test_workloads(self):
+        for workload in jmcbench.WORKLOADS.values():
+            self.assertEqual(workload(50), workload(50))
+            self.assertEqual(len(workload(50)), 50)
+
+    def test_run(self):
+        result = jmcbench.run(MODEL, "random", "best", 100, 1)
+        self.assertEqual(result["lines"], 100)
+        self.assertGreater(result["lines_per_second"], 0)
+        self.assertGreater(result["peak_rss"], 0)
+
+
+class TestStats(JmcTestCase):
+    def test_instrument(self):
+        stats = jmcstats.Stats()
+        model = stats.instrument(jmc.Jmc.load(MODEL))
+        lines = self.decorated(["praha", "karlin", "qxqzzj", "praha"])
+        for line in stats.timed("input", lines):
+            self.assertEqual(model.loss(line), self.model.loss(line))
+        report = stats.report()
+        self.assertEqual(report["lines"], 4)
+        ngrams = sum(len(line) - model.order + 1 for line in lines)
+        self.assertEqual(sum(report["backoff_depth"].values()), ngrams)
+        # The repeated line is scored from the cache:
+        self.assertEqual(report["cache_hits"] + report["cache_misses"],
+                         ngrams)
+        self.assertGreaterEqual(report["cache_hits"],
+                                len(lines[-1]) - model.order + 1)
+        self.assertEqual(report["model_sizes"], list(map(len, model.stats)))
+
+    def test_heap_replacements(self):
+        stats = jmcstats.Stats()
+        model = stats.instrument(jmc.Jmc.load(MODEL))
+        # Each line is better than all before it:
+        lines = [(5, "a"), (4, "b"), (3, "c"), (2, "d"), (1, "e")]
+        top = model.nlargest(
+            2, iter(lines), key=lambda pair, top=0: -pair[0],
+            counters=model.counters,
+        )
+        self.assertEqual(top, [(1, "e"), (2, "d")])
+        self.assertEqual(stats.report()["heap_replacements"], 3)
+
+
+class TestShardedCounting(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "train.txt")
+        with open(self.filename, "w", encoding="utf-8", newline="") as fp:
+            fp.write("praha\nbrno\n\nostrava\r\nkarl\u00edn\rplze\u0148")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_shard(self):
+        with open(self.filename, encoding="utf-8") as fp:
+            expected = list(fp)
+        size = os.path.getsize(self.filename)
+        for jobs in range(1, size + 2):
+            lines = []
+            for k in range(jobs):
+                lines.extend(ngram_model.read_shard(
+                    self.filename, size*k//jobs, size*(k + 1)//jobs, "utf-8"
+                ))
+            self.assertEqual(lines, expected)
+
+    def test_train(self):
+        sequential = ngram_model.SmoothedNGramModel(3)
+        with open(self.filename, encoding="utf-8") as fp:
+            sequential.train(fp)
+        sharded = ngram_model.SmoothedNGramModel(3)
+        with open(self.filename, encoding="utf-8") as fp:
+            sharded.train(fp, jobs=3)
+        self.assertEqual(sharded.counts, sequential.counts)
+        self.assertEqual(
+            [list(counts) for counts in sharded.counts],
+            [list(counts) for counts in sequential.counts],
+        )
+
+    def test_train_spawn(self):
+        preprocess = functools.partial(
+            string_util.preprocess, normalize=True, lowercase=True,
+            add_blanks=True, order=3,
+        )
+        sequential = ngram_model.SmoothedNGramModel(3)
+        with open(self.filename, encoding="utf-8") as fp:
+            sequential.train(fp, preprocess=preprocess)
+        sharded = ngram_model.SmoothedNGramModel(3)
+        spawn = multiprocessing.get_context("spawn")
+        with unittest.mock.patch.object(
+                ngram_model.multiprocessing, "Pool", spawn.Pool):
+            with open(self.filename, encoding="utf-8") as fp:
+                sharded.train(fp, preprocess=preprocess, jobs=2)
+        self.assertEqual(sharded.counts, sequential.counts)
+
+    def test_train_external(self):
+        in_memory = ngram_model.SmoothedNGramModel(3)
+        with open(self.filename, encoding="utf-8") as fp:
+            in_memory.train(fp)
+        for memsize in (0, 300, 2**20):
+            external = ngram_model.SmoothedNGramModel(3)
+            with open(self.filename, encoding="utf-8") as fp:
+                external.train(fp, memsize=memsize)
+            self.assertEqual(external.counts, in_memory.counts)
+            self.assertEqual(external.totals, in_memory.totals)
+            # Counts come in sorted order, not in the order of first
+            # occurrence:
+            self.assertEqual(
+                [list(counts) for counts in external.counts],
+                [sorted(counts) for counts in in_memory.counts],
+            )
+        self.assertEqual(external.counts[2]["zzz"], 0)
+        self.assertNotIn("zzz", external.counts[2])
+        self.assertEqual(pickle.loads(pickle.dumps(external.counts)),
+                         in_memory.counts)
+
+
+@unittest.skipUnless(ngram_model.numpy, "requires numpy")
+class TestSmoothing(unittest.TestCase):
+    def setUp(self):
+        self.model = ngram_model.SmoothedNGramModel(3)
+        self.model.train(["praha", "brno", "ostrava", "plzen", "liberec"])
+        self.model.heldout(["olomouc", "brno", "pardubice"])
+
+    def test_matches_loops(self):
+        with unittest.mock.patch.object(ngram_model, "numpy", None):
+            expected = self.model.lambda_expectation()
+            expected_xent = self.model.heldout_xent()
+        matrix = self.model.heldout_matrix()
+        for count, expected_count in zip(
+                self.model.lambda_expectation(matrix), expected):
+            self.assertAlmostEqual(count, expected_count)
+        self.assertAlmostEqual(self.model.heldout_xent(matrix), expected_xent)
+        self.assertAlmostEqual(self.model.heldout_xent(), expected_xent)
+
+
+class TestExport(unittest.TestCase):
+    def test_dump(self):
+        model = ngram_model.SmoothedNGramModel(3)
+        model.train(["\u2581\u2581praha\u2581", "\u2581\u2581brno\u2581"])
+        model.lambdas = [0.2, 0.3, 0.5]
+        with tempfile.TemporaryFile() as fp:
+            jmcexport.dump(model, fp)
+            fp.seek(0)
+            exported = jmc.Jmc.load(fp)
+        self.assertEqual(
+            [len(branch) for branch in exported.stats],
+            [sum(map(len, model.counts[:3 - branch])) for branch in range(3)],
+        )
+        for gram in model.counts[2]:
+            self.assertAlmostEqual(
+                exported.stats[0][gram.replace("\u2581", "\n")],
+                -math.log(model.interpolated_prob(gram)),
+            )
+        self.assertEqual(
+            exported.min_losses,
+            [min(branch.values()) for branch in exported.stats],
+        )
+
+    def test_dump_external(self):
+        lines = ["\u2581\u2581praha\u2581", "\u2581\u2581brno\u2581"]
+        model = ngram_model.SmoothedNGramModel(3)
+        model.train(lines)
+        external = ngram_model.SmoothedNGramModel(3)
+        external.train(lines, memsize=0)
+        dumps = []
+        for trained, memsize in [(model, None), (external, 0)]:
+            trained.lambdas = [0.2, 0.3, 0.5]
+            with io.BytesIO() as fp:
+                jmcexport.dump(trained, fp, memsize=memsize)
+                dumps.append(gzip.decompress(fp.getvalue()))
+        self.assertEqual(dumps[0], dumps[1])
+
+
+class TestTextnorm(unittest.TestCase):
+    def test_latin(self):
+        lines = ["P\u0159\u00edli\u0161 \u017elu\u0165ou\u010dk\u00fd k\u016f\u0148",
+                 "", "Karl\u00edn 2\n", "\u2163. \u0442\u0435\u0441\u0442"]
+        expected = ["priliszlutouckykun", "", "karlin", "iv"]
+        self.assertEqual([textnorm.LATIN(line.rstrip("\n"))
+                          for line in lines], expected)
+        self.assertEqual(list(textnorm.LATIN.lines(lines, 3)), expected)
+        self.assertEqual(textnorm.LETTERS("\u010cesk\u00e9 Bud\u011bjovice"),
+                         "CeskeBudejovice")
+
+    def test_table(self):
+        policy = textnorm.Policy(table={"\u2161": "II", "\u200b": ""})
+        self.assertEqual(policy("Karel\u200b \u2161."), "Karel II.")
+        self.assertEqual(list(policy.lines(["\u2161\n", "a\u200bb"])),
+                         ["II", "ab"])
+
+    def test_newline_replacement(self):
+        policy = textnorm.Policy(table={"|": "\n"})
+        self.assertEqual(list(policy.lines(["a|b", "c"])), ["a\nb", "c"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+##
+# Copyright (C) 2022 Tomas "trosos" Tintera
+#
+# Permission to use, copy, modify, and/or distribute this
+# software for any purpose with or without fee is hereby
+# granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS
+# ALL WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH
+# THE USE OR PERFORMANCE OF THIS SOFTWARE.
+##
+
+# Text normalization shared by all the tools.
+#
+# A normalization policy is a translation table for `str.translate`.
+# All the policies transform text character by character (NFKD
+# decomposition, `unidecode`, lowercasing of ASCII and filtering of
+# characters all do), so the replacement of each code point is computed
+# on its first occurrence only and kept in the table. Then normalizing
+# a line is a single call of `str.translate`, and normalizing many lines
+# is a single call per batch of lines.
+#
+# The other directories link to this module.
+
+__all__ = [
+    "Policy",
+    "LATIN", "LETTERS", "ALPHA", "ALNUM", "ASCII",
+]
+
+import itertools
+import re
+import unicodedata
+
+DEFAULT_BATCH_SIZE = 2**12
+_NEWLINE = ord("\n")
+
+
+class Policy(dict):
+    """Normalization policy, usable as a table for `str.translate`.
+
+    Characters in `table` are replaced as given, any other character
+    by `transliterate(char)`, which is called once per code point.
+    By default, other characters are left as they are.
+    """
+
+    def __init__(self, transliterate=None, table=()):
+        super().__init__(
+            (ord(char), replacement)
+            for char, replacement in dict(table).items()
+        )
+        self.transliterate = transliterate
+        self._batch_table = _NewlineTable(self)
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        if self.transliterate is not None:
+            char = self.transliterate(char)
+        self[codepoint] = char
+        return char
+
+    def __call__(self, text):
+        return text.translate(self)
+
+    def lines(self, lines, batch_size=DEFAULT_BATCH_SIZE):
+        """Yield normalized lines, with trailing newlines stripped.
+
+        Lines are joined into batches of `batch_size`, translated at once
+        and split again. Should a replacement contain a newline, such
+        a batch is translated line by line.
+        """
+        it = iter(lines)
+        while True:
+            batch = [
+                line.rstrip("\n")
+                for line in itertools.islice(it, batch_size)
+            ]
+            if not batch:
+                return
+            translated = "\n".join(batch).translate(self._batch_table) \
+                .split("\n")
+            if len(translated) != len(batch):
+                translated = [line.translate(self) for line in batch]
+            yield from translated
+
+
+class _NewlineTable(dict):
+    """Table of a policy, but keeping newlines."""
+
+    def __init__(self, policy):
+        super().__init__({_NEWLINE: "\n"})
+        self.policy = policy
+
+    def __missing__(self, codepoint):
+        replacement = self[codepoint] = self.policy[codepoint]
+        return replacement
+
+
+def _filter(pattern):
+    return re.compile(pattern).sub
+
+
+_nonlatin = _filter("[^a-z]")
+_nonletter = _filter("[^a-zA-Z]")
+_nonalnum = _filter("[^0-9a-z]")
+
+
+def _unidecode(char):
+    import unidecode
+    return unidecode.unidecode(char)
+
+
+# Remove diacritics, leave only lowercase Latin letters:
+LATIN = Policy(lambda char: _nonlatin(
+    "", unicodedata.normalize("NFKD", char).lower()
+))
+# Remove diacritics, leave only Latin letters:
+LETTERS = Policy(lambda char: _nonletter(
+    "", unicodedata.normalize("NFKD", char)
+))
+# Transliterate to lowercase Latin letters, without numerals:
+ALPHA = Policy(lambda char: _nonlatin("", _unidecode(char).lower()))
+# Transliterate to lowercase Latin letters and numerals:
+ALNUM = Policy(lambda char: _nonalnum("", _unidecode(char).lower()))
+# Transliterate to ASCII:
+ASCII = Policy(_unidecode)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import logging
 import sys
 
+import jmcexport
 from ngram_model import SmoothedNGramModel
 from string_util import preprocess
 
@@ -16,16 +18,22 @@ def main(args):
     logger.info("Hello! This is %s", sys.argv[0])
 
     model = SmoothedNGramModel(args.order)
-    model.train(args.input, preprocess=lambda x: preprocess(
-        x, args.normalize, args.lowercase, args.add_blanks, args.order))
+    # A partial rather than a lambda, so that worker processes get it
+    # pickled under any start method:
+    line_preprocess = functools.partial(
+        preprocess, normalize=args.normalize, lowercase=args.lowercase,
+        add_blanks=args.add_blanks, order=args.order)
+
+    model.train(args.input, preprocess=line_preprocess,
+        jobs=args.jobs, memsize=args.memsize)
 
     logger.info("Train data loaded, n-gram stats:")
     for n in range(model.order):
         logger.info("%d-grams: %d", n + 1, len(model.counts[n]))
 
     logger.info("Loading heldout set.")
-    model.heldout(args.heldout, preprocess=lambda x: preprocess(
-        x, args.normalize, args.lowercase, args.add_blanks, args.order))
+    model.heldout(args.heldout, preprocess=line_preprocess,
+        jobs=args.jobs, memsize=args.memsize)
 
     logger.info("Heldout data loaded, n-gram stats:")
     for n in range(model.order):
@@ -53,8 +61,13 @@ def main(args):
     for n in range(model.order):
         logger.info("%d: %.4f", n + 1, model.lambdas[n])
 
-    logger.info("Saving model to %s", args.output)
-    model.save(args.output)
+    if args.output.endswith(".jmc"):
+        logger.info("Exporting model to %s", args.output)
+        with open(args.output, "wb") as f:
+            jmcexport.dump(model, f, memsize=args.memsize)
+    else:
+        logger.info("Saving model to %s", args.output)
+        model.save(args.output)
 
 
 if __name__ == "__main__":
@@ -62,7 +75,7 @@ if __name__ == "__main__":
 
     # pylint: disable=line-too-long
     parser.add_argument("input", nargs="?", metavar="INPUT_TRAIN", help="Input file. Plaintext. Default stdin.", default=sys.stdin, type=argparse.FileType("r"))
-    parser.add_argument("output", nargs="?", metavar="MODEL_FILE", help="Model file", type=str)
+    parser.add_argument("output", nargs="?", metavar="MODEL_FILE", help="Model file. Pickled model, or a model for jmc if it ends with .jmc", type=str)
     parser.add_argument("heldout", nargs="?", metavar="INPUT_HELDOUT", help="Heldout data. Plaintext.", type=argparse.FileType("r"))
 
     parser.add_argument("-n", "--order", help="Order of the language model. Default 4", default=4, type=int)
@@ -71,6 +84,9 @@ if __name__ == "__main__":
     parser.add_argument("--add-blanks", help="Circumfix the lines with blank characters", default=True, type=bool)
     parser.add_argument("--epsilon", help="Convergence criterion. Small number.", default=1.0e-4, type=float)
     parser.add_argument("--valid-every", help="Number of iterations between validations.", default=10, type=int)
+    parser.add_argument("-j", "--jobs", help="Count n-grams of input files in this many processes. Default 1", default=1, type=int)
+
+    parser.add_argument("--memsize", help="Count n-grams in temporary files, using about this many bytes of memory for counting. Default: count in memory", default=None, type=int)
 
     p_args = parser.parse_args(sys.argv[1:])
     main(p_args)
@@ -16,22 +16,31 @@
 # THE USE OR PERFORMANCE OF THIS SOFTWARE.
 ##
 
-def normalize(text):
-    return (text
-        .replace("\u00a0", " ")    # NBSP
-        .replace("\u200b", "")     # ZWSP
-        .replace("\u2013", "-")    # NDASH
-        .replace("\u2014", "-")    # MDASH
-        .replace("\u2019", "'")    # Right Single Quotation Mark
-        .replace("\u2160", "I")    # Roman Numeral One
-        .replace("\u2161", "II")   # Roman Numeral Two
-        .replace("\u2162", "III")  # Roman Numeral Three
-        .replace("\u2163", "IV")   # Roman Numeral Four
-        .replace("\u2164", "V")    # Roman Numeral Five
-        .replace("\u2165", "VI")   # Roman Numeral Six
-        .replace("\u2166", "VII")  # Roman Numeral Seven
-        .replace("\u2167", "VIII") # Roman Numeral Eight
-        .replace("\u2168", "IX")   # Roman Numeral Nine
-        .replace("\u2169", "X")    # Roman Numeral Ten
-        .replace("\u21d4", "<=>")  # Left Right Double Arrow
-    )
+import os
+import sys
+
+# textnorm lives in ../character_ngram:
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "character_ngram"
+))
+import textnorm
+
+# Typographic variants found in OSM names:
+normalize = textnorm.Policy(table={
+    "\u00a0": " ",    # NBSP
+    "\u200b": "",     # ZWSP
+    "\u2013": "-",    # NDASH
+    "\u2014": "-",    # MDASH
+    "\u2019": "'",    # Right Single Quotation Mark
+    "\u2160": "I",    # Roman Numeral One
+    "\u2161": "II",   # Roman Numeral Two
+    "\u2162": "III",  # Roman Numeral Three
+    "\u2163": "IV",   # Roman Numeral Four
+    "\u2164": "V",    # Roman Numeral Five
+    "\u2165": "VI",   # Roman Numeral Six
+    "\u2166": "VII",  # Roman Numeral Seven
+    "\u2167": "VIII", # Roman Numeral Eight
+    "\u2168": "IX",   # Roman Numeral Nine
+    "\u2169": "X",    # Roman Numeral Ten
+    "\u21d4": "<=>",  # Left Right Double Arrow
+})
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
 import logging
 import pandas as pd
 import itertools
-import unidecode
+# textnorm lives in ../character_ngram:
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "character_ngram"
+))
+import textnorm
 import re
 import random
 import generator
@@ -32,8 +37,7 @@ class SubseqPOICracker:
         if self.use_unicode:
             s = re.sub(r'[^\w\d]+', '', s)
         else:
-            s = unidecode.unidecode(s)
-            s = re.sub(r'[^0-9a-zA-Z]+', '', s)
+            s = textnorm.ALNUM(s)
 
         s = s.lower()
 
@@ -62,7 +66,7 @@ class SubseqPOICracker:
                 example = "".join(example)
 
             if not self.use_unicode:
-                example = unidecode.unidecode(example)
+                example = textnorm.ASCII(example)
 
             letset = list(example)
             if self.permute: